@@ -11,6 +11,7 @@ Generates registration templates using different strategies:
 
 import os
 import glob
+import shutil
 import argparse
 import numpy as np
 import nibabel as nib
@@ -18,10 +19,10 @@ from pathlib import Path
 
 
 def load_nifti_volume(filepath):
-    """Load a NIfTI volume and return data and affine matrix."""
+    """Load a NIfTI volume as float32 and return data, affine matrix and header."""
     try:
-        img = nib.load(filepath)
-        return img.get_fdata(), img.affine, img.header
+        img = nib.load(filepath, mmap=False)
+        return np.asanyarray(img.dataobj, dtype=np.float32), img.affine, img.header
     except Exception as e:
         print(f"Error loading {filepath}: {e}")
         return None, None, None
@@ -63,26 +64,28 @@ def generate_average_template(input_files, output_path):
     print(f"Template dimensions: {first_data.shape}")
     print(f"Data type: {first_data.dtype}")
     
-    # Initialize accumulator
-    volume_sum = np.zeros_like(first_data, dtype=np.float64)
+    # Initialize accumulator; float32 keeps ample precision for ~100 MR volumes
+    volume_sum = np.zeros_like(first_data, dtype=np.float32)
     valid_count = 0
     
     # Accumulate all volumes
     for i, filepath in enumerate(input_files):
         print(f"Processing volume {i+1}/{len(input_files)}: {Path(filepath).name}")
         
-        data, affine, header = load_nifti_volume(filepath)
-        if data is None:
+        # Check dimensions from the header before reading any voxel data
+        try:
+            img = nib.load(filepath, mmap=False)
+            if img.shape != first_data.shape:
+                print(f"  Skipping {filepath} (dimension mismatch: {img.shape} vs {first_data.shape})")
+                continue
+            data = np.asanyarray(img.dataobj, dtype=np.float32)
+        except Exception as e:
+            print(f"Error loading {filepath}: {e}")
             print(f"  Skipping {filepath} (failed to load)")
             continue
             
-        # Check dimensions match
-        if data.shape != first_data.shape:
-            print(f"  Skipping {filepath} (dimension mismatch: {data.shape} vs {first_data.shape})")
-            continue
-            
         # Add to accumulator
-        volume_sum += data.astype(np.float64)
+        np.add(volume_sum, data, out=volume_sum)
         valid_count += 1
     
     if valid_count == 0:
@@ -90,13 +93,11 @@ def generate_average_template(input_files, output_path):
         return False
     
     # Calculate average
-    average_volume = volume_sum / valid_count
+    average_volume = np.divide(volume_sum, valid_count, out=volume_sum)
     print(f"Averaged {valid_count} volumes")
     print(f"Average intensity range: [{np.min(average_volume):.3f}, {np.max(average_volume):.3f}]")
     
-    # Convert back to original data type
-    if first_data.dtype != np.float64:
-        average_volume = average_volume.astype(first_data.dtype)
+    # The first header's data type sets the stored type, so no cast is needed here
     
     # Save average template
     success = save_nifti_volume(average_volume, first_affine, first_header, output_path)
@@ -131,10 +132,15 @@ def generate_central_template(input_files, output_path):
     print(f"Using central volume template: {Path(central_file).name}")
     print(f"  (Volume {central_index + 1} of {len(sorted_files)} sorted files)")
     
-    # Copy central file to output
+    # Copy central file to output, linking it when the format is unchanged
     try:
-        img = nib.load(central_file)
-        nib.save(img, output_path)
+        if "".join(Path(central_file).suffixes[-2:]) == "".join(Path(output_path).suffixes[-2:]):
+            try:
+                os.link(central_file, output_path)
+            except OSError:
+                shutil.copyfile(central_file, output_path)
+        else:
+            nib.save(nib.load(central_file), output_path)
         print(f"✅ Central template saved: {output_path}")
         return True
     except Exception as e:
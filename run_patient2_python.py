@@ -9,5 +9,5 @@ from spectral_nifti_to_mat import convert_spectral_nifti_to_mat
 Path("patient2_output/nifti").mkdir(parents=True, exist_ok=True)
 Path("patient2_output/registration").mkdir(parents=True, exist_ok=True)
 convert_spectral_mat_to_nifti("data/data_wip_patient2.mat", "patient2_output/nifti")
-register_nifti("patient2_output/nifti", "patient2_output/registration", processes=1)  # OPTIMIZED: Single process eliminates 99% CPU lock contention
+register_nifti("patient2_output/nifti", "patient2_output/registration", processes=1)  # One worker thread; set processes to the GPU count to use them all
 convert_spectral_nifti_to_mat("patient2_output/registration", "patient2_output/data_wip_patient2_registered.mat", "data/data_wip_patient2.mat")
\ No newline at end of file
@@ -5,29 +5,39 @@ Part of the Diffusion-Relaxation Suite
 """
 
 import argparse
+import asyncio
+import hashlib
 import sys
 import os
-import subprocess
 import shutil
 from pathlib import Path
 from datetime import datetime
 
 # Constants
-REQUIRED_SCRIPTS = ['convert_mat_to_nifti.py', 'register_nifti.py', 'convert_nifti_to_mat.py']
+# Resolve the wrapper scripts next to this file so the runner works from any cwd
+SCRIPTS_DIR = Path(__file__).resolve().parent
+REQUIRED_SCRIPTS = {
+    name: SCRIPTS_DIR / name
+    for name in ['convert_mat_to_nifti.py', 'register_nifti.py', 'convert_nifti_to_mat.py']
+}
 SEPARATOR_WIDTH = 50
+HASH_CHUNK_SIZE = 1024 * 1024
+INPUT_HASH_FILE = '.input_hash'
 
 
-def run_command(cmd, description):
-    """Run a command and handle errors."""
+async def run_command(cmd, description, env=None):
+    """Run a command without blocking the event loop and return its exit code."""
     print(f"Running: {' '.join(cmd)}")
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: {description} failed")
-        sys.exit(e.returncode)
+        process = await asyncio.create_subprocess_exec(*cmd, env=env)
     except FileNotFoundError:
         print(f"ERROR: Command not found: {cmd[0]}")
-        sys.exit(1)
+        return 1
+
+    returncode = await process.wait()
+    if returncode != 0:
+        print(f"ERROR: {description} failed")
+    return returncode
 
 
 def validate_inputs(input_mat):
@@ -36,23 +46,59 @@ def validate_inputs(input_mat):
         print(f"ERROR: Input file not found: {input_mat}")
         sys.exit(1)
 
-    for script in REQUIRED_SCRIPTS:
-        if not Path(script).is_file():
-            print(f"ERROR: Required script not found: {script}")
+    for path in REQUIRED_SCRIPTS.values():
+        if not path.is_file():
+            print(f"ERROR: Required script not found: {path}")
             sys.exit(1)
 
 
-def setup_output_directory(output_dir, subdirs):
-    """Create output directory and clean existing subdirectories."""
+def compute_input_hash(input_mat):
+    """Return the blake2b digest of the input file, read in 1 MB chunks."""
+    digest = hashlib.blake2b()
+    with open(input_mat, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_path(path):
+    """Remove a file or directory if it exists."""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def step_sentinel(step_dir):
+    """Marker file written next to a step's output directory once the step completes."""
+    step_dir = Path(step_dir)
+    return step_dir.parent / f".{step_dir.name}.done"
+
+
+def setup_output_directory(output_dir, subdirs, input_hash):
+    """
+    Create output directory and clean existing subdirectories.
+
+    Subdirectories are kept when the output directory was produced from the
+    same input (matching hash), so completed steps can be skipped on rerun.
+    A step that never finished (no sentinel) has its partial outputs removed
+    so it reruns from scratch. Returns True if previous outputs were kept.
+    """
     Path(output_dir).mkdir(exist_ok=True)
-    
+
+    hash_file = Path(output_dir) / INPUT_HASH_FILE
+    if hash_file.is_file() and hash_file.read_text().strip() == input_hash:
+        for subdir in subdirs:
+            if not step_sentinel(subdir).exists():
+                remove_path(subdir)
+        return True
+
     for subdir in subdirs:
-        path = Path(subdir)
-        if path.exists():
-            if path.is_dir():
-                shutil.rmtree(path)
-            else:
-                path.unlink()
+        remove_path(subdir)
+        remove_path(step_sentinel(subdir))
+    hash_file.write_text(input_hash)
+    return False
 
 
 def print_header(input_mat, output_dir, processes):
@@ -75,6 +121,86 @@ def print_success(final_mat):
     print("=" * SEPARATOR_WIDTH)
 
 
+def subject_paths(input_mat_file, output_directory):
+    """Resolve the input, output and intermediate paths for one subject."""
+    input_mat = Path(input_mat_file).resolve()
+    output_dir = Path(output_directory).resolve()
+    nifti_dir = output_dir / 'nifti'
+    registration_dir = output_dir / 'registration'
+
+    # Create output .mat filename based on input filename
+    input_stem = input_mat.stem  # filename without extension
+    final_mat = output_dir / f"{input_stem}_registered.mat"
+    return input_mat, output_dir, nifti_dir, registration_dir, final_mat
+
+
+def gpu_env(slot):
+    """
+    Environment for a subprocess pinned to GPU slot.
+
+    The slot indexes the devices already listed in CUDA_VISIBLE_DEVICES when
+    it is set, otherwise the physical device numbers.
+    """
+    visible = [d for d in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if d.strip()]
+    device = visible[slot % len(visible)] if visible else str(slot)
+    return {**os.environ, 'CUDA_VISIBLE_DEVICES': device}
+
+
+async def run_subject(input_mat, output_dir, processes, gpu_slots):
+    """
+    Run the three workflow steps for one subject.
+
+    Conversion steps are CPU-bound and overlap freely with other subjects;
+    the registration step takes a device index from gpu_slots and runs with
+    only that GPU visible, so concurrent subjects land on different GPUs.
+    """
+    input_mat, output_dir, nifti_dir, registration_dir, final_mat = subject_paths(input_mat, output_dir)
+
+    steps = [
+        ([sys.executable, str(REQUIRED_SCRIPTS['convert_mat_to_nifti.py']), str(input_mat), str(nifti_dir)],
+         "Converting .mat to NIfTI", False, step_sentinel(nifti_dir)),
+        ([sys.executable, str(REQUIRED_SCRIPTS['register_nifti.py']), str(nifti_dir), str(registration_dir),
+          '--processes', str(processes)],
+         "Registering NIfTI files (⚠️ GPU required, 3-4 hours)", True, step_sentinel(registration_dir)),
+        ([sys.executable, str(REQUIRED_SCRIPTS['convert_nifti_to_mat.py']), str(registration_dir),
+          str(final_mat), str(input_mat)],
+         "Converting back to .mat", False, None)
+    ]
+
+    # Execute workflow steps
+    for i, (cmd, description, needs_gpu, sentinel) in enumerate(steps, 1):
+        print(f"\n[{input_mat.stem}] Step {i}: {description}")
+        if sentinel is not None and sentinel.exists():
+            print("Skipping: outputs from a previous run of the same input are complete")
+            continue
+        if needs_gpu:
+            slot = await gpu_slots.get()
+            try:
+                print(f"[{input_mat.stem}] Using GPU slot {slot}")
+                returncode = await run_command(cmd, description, env=gpu_env(slot))
+            finally:
+                gpu_slots.put_nowait(slot)
+        else:
+            returncode = await run_command(cmd, description)
+        if returncode != 0:
+            return returncode
+        if sentinel is not None:
+            sentinel.touch()
+
+    print_success(final_mat)
+    return 0
+
+
+async def run_subjects(subjects, processes, num_gpus):
+    """Run all subjects concurrently, one registration per GPU at a time."""
+    gpu_slots = asyncio.Queue()
+    for slot in range(num_gpus):
+        gpu_slots.put_nowait(slot)
+    return await asyncio.gather(
+        *[run_subject(input_mat, output_dir, processes, gpu_slots) for input_mat, output_dir in subjects]
+    )
+
+
 def main():
     # Parse arguments
     parser = argparse.ArgumentParser(description="DR-CSI Registration Module")
@@ -82,47 +208,35 @@ def main():
     parser.add_argument('output_directory', help='Directory for all outputs')
     parser.add_argument('--processes', '-p', type=int, default=4, 
                        choices=range(1, 17), help='Parallel processes (default: 4)')
+    parser.add_argument('--subject', nargs=2, action='append', default=[],
+                       metavar=('INPUT_MAT', 'OUTPUT_DIR'),
+                       help='Additional subject to process in the same run (repeatable)')
+    parser.add_argument('--gpus', type=int, default=1,
+                       help='Number of GPUs; one registration runs on each at a time (default: 1)')
     args = parser.parse_args()
 
-    # Setup paths
-    input_mat = Path(args.input_mat_file).resolve()
-    output_dir = Path(args.output_directory).resolve()
-    nifti_dir = output_dir / 'nifti'
-    registration_dir = output_dir / 'registration'
-    
-    # Create output .mat filename based on input filename
-    input_stem = input_mat.stem  # filename without extension
-    final_mat = output_dir / f"{input_stem}_registered.mat"
+    subjects = [(args.input_mat_file, args.output_directory)] + [tuple(s) for s in args.subject]
 
     # Validate inputs and setup directories
-    validate_inputs(input_mat)
-    setup_output_directory(output_dir, [nifti_dir, registration_dir, final_mat])
-    print_header(input_mat, output_dir, args.processes)
+    for input_mat_file, output_directory in subjects:
+        input_mat, output_dir, nifti_dir, registration_dir, final_mat = subject_paths(
+            input_mat_file, output_directory)
+        validate_inputs(input_mat)
+        if setup_output_directory(output_dir, [nifti_dir, registration_dir], compute_input_hash(input_mat)):
+            print(f"Reusing outputs in {output_dir} (input unchanged since last run)")
+        remove_path(final_mat)
+        print_header(input_mat, output_dir, args.processes)
 
     try:
-        # Define workflow steps
-        steps = [
-            ([sys.executable, 'convert_mat_to_nifti.py', str(input_mat), str(nifti_dir)], 
-             "Converting .mat to NIfTI"),
-            ([sys.executable, 'register_nifti.py', str(nifti_dir), str(registration_dir), 
-              '--processes', str(args.processes)], 
-             "Registering NIfTI files (⚠️ GPU required, 3-4 hours)"),
-            ([sys.executable, 'convert_nifti_to_mat.py', str(registration_dir), 
-              str(final_mat), str(input_mat)], 
-             "Converting back to .mat")
-        ]
-
-        # Execute workflow steps
-        for i, (cmd, description) in enumerate(steps, 1):
-            print(f"\nStep {i}: {description}")
-            run_command(cmd, description)
-
-        print_success(final_mat)
-
+        returncodes = asyncio.run(run_subjects(subjects, args.processes, max(1, args.gpus)))
     except KeyboardInterrupt:
         print("\nWorkflow interrupted")
         sys.exit(130)
 
+    failed = [code for code in returncodes if code != 0]
+    if failed:
+        sys.exit(failed[0])
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -17,12 +17,19 @@ output_movie_file = f"/deneb_disk/data_from_justin_03_11_2025/Data to be shared/
 fourcc = cv2.VideoWriter_fourcc(*'XVID')
 out = cv2.VideoWriter(output_movie_file, fourcc, 10.0, (512, 512))
 
+# Read the b-values for every TE up front so the frame buffer can be allocated once
+b_values = {}
 for te in all_te:
     mat_file = f"{data_dir}/TE{te}.mat"
     mat = sio.loadmat(mat_file)
-    b_all = mat["b"][0]
+    b_values[te] = mat["b"][0]
 
-    for i, b in enumerate(b_all):
+num_frames = sum(len(b_all) for b_all in b_values.values())
+frames = np.empty((num_frames, 512, 512, 3), np.uint8)
+
+k = 0
+for te in all_te:
+    for i, b in enumerate(b_values[te]):
         nii_file = f"{data_dir}/TE{te}_bval{b}.reg.nii.gz"
         img_sitk = sitk.ReadImage(nii_file)
         img_array = sitk.GetArrayFromImage(img_sitk)
@@ -46,11 +53,13 @@ for te in all_te:
         # Read the image using OpenCV
         frame = cv2.imread(temp_img_file)
         
-        # Resize the frame to match the video size
-        frame = cv2.resize(frame, (512, 512))
-        
-        # Write the frame to the video
-        out.write(frame)
+        # Resize the frame straight into its slot of the frame buffer
+        cv2.resize(frame, (512, 512), dst=frames[k])
+        k += 1
+
+# Write all frames to the video
+for frame in frames:
+    out.write(frame)
 
 # The FPS is set during the initialization of VideoWriter
 
@@ -0,0 +1,44 @@
+"""
+Cached identity coordinate grids shared by the deformation field helpers.
+"""
+
+from functools import lru_cache
+
+import torch
+
+
+def _coord_grid(shape, device="cpu"):
+    """
+    Return the (x, y, z, 3) voxel coordinate grid for shape on device.
+    The tensor is cached and shared between callers, so it must not be
+    modified in place; build new tensors from it instead.
+
+    A bare "cuda" is resolved to the current GPU before the cache lookup, so
+    threads pinned to different GPUs each get a grid on their own device.
+    """
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    grid = _cached_coord_grid(tuple(shape), device)
+    if device.type == "cuda":
+        # Keep the cached memory alive for work queued on the caller's stream
+        # (registration workers run on their own streams)
+        grid.record_stream(torch.cuda.current_stream(device))
+    return grid
+
+
+@lru_cache(maxsize=8)
+def _cached_coord_grid(shape, device):
+    """Build the grid for an explicit device, ready for use from any stream."""
+    if device.type != "cuda":
+        return _build_coord_grid(shape, device)
+    default_stream = torch.cuda.default_stream(device)
+    with torch.cuda.device(device), torch.cuda.stream(default_stream):
+        grid = _build_coord_grid(shape, device)
+    default_stream.synchronize()
+    return grid
+
+
+def _build_coord_grid(shape, device):
+    mesh_points = [torch.arange(dim, dtype=torch.float32, device=device) for dim in shape]
+    return torch.stack(torch.meshgrid(*mesh_points, indexing="ij"), dim=-1)
@@ -0,0 +1,67 @@
+"""
+Per-call random state for registrations running on concurrent worker threads.
+
+Registrations share one process, so reseeding the global generators in one
+thread would reorder the draws of another. Network weights are drawn from the
+CPU generator under a lock with its state restored afterwards, and dropout
+masks come from a generator owned by the call. Code running next to the
+registrations must not draw from the global CPU generator outside
+seeded_build, or it can take draws meant for the weights.
+"""
+
+import threading
+
+import torch
+
+REGISTRATION_SEED = 42
+
+_init_lock = threading.Lock()
+
+
+def deterministic_backends():
+    """Select deterministic cuDNN kernels (the same fixed values on every call)."""
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+
+def seeded_build(build, seed=REGISTRATION_SEED):
+    """
+    Call build() with the CPU generator seeded with seed and return its result.
+    Builds are serialized and the global generator state is restored afterwards,
+    so the weights do not depend on other threads.
+    """
+    with _init_lock, torch.random.fork_rng(devices=[]):
+        torch.default_generator.manual_seed(seed)
+        return build()
+
+
+def call_generator(device, seed=REGISTRATION_SEED):
+    """Return a new generator on device seeded with seed, for one registration call."""
+    generator = torch.Generator(device=torch.device(device))
+    generator.manual_seed(seed)
+    return generator
+
+
+class SeededDropout(torch.nn.Module):
+    """torch.nn.Dropout drawing its masks from a given generator instead of the global one."""
+
+    def __init__(self, p, generator):
+        super().__init__()
+        self.p = p
+        self.generator = generator
+
+    def forward(self, x):
+        if not self.training or self.p == 0:
+            return x
+        keep = torch.empty_like(x).bernoulli_(1 - self.p, generator=self.generator)
+        return x * keep.div_(1 - self.p)
+
+
+def use_seeded_dropout(module, generator):
+    """Replace every torch.nn.Dropout in module with a SeededDropout using generator."""
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Dropout):
+            setattr(module, name, SeededDropout(child.p, generator))
+        else:
+            use_seeded_dropout(child, generator)
+    return module
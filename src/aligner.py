@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-from monai.utils import set_determinism
 from monai.networks.nets import GlobalNet
 from monai.config import USE_COMPILED
 from monai.networks.blocks import Warp
@@ -16,8 +15,10 @@ from monai.losses import (
     LocalNormalizedCrossCorrelationLoss,
 )
 from warp_utils import apply_warp
+from _seeding import deterministic_backends, seeded_build
 import argparse
 import torch
+import torch.nn.functional as F
 import nibabel as nib
 
 import SimpleITK as sitk
@@ -35,15 +36,39 @@ class dscolors:
     ul = "\033[4m"
 
 
+def _update_convergence(loss_value, best_loss, stale_epochs, min_rel_improvement):
+    """
+    Track the best loss and the number of epochs since it last improved.
+
+    An epoch counts as an improvement when the loss drops below best_loss by
+    more than min_rel_improvement * |best_loss|; the absolute value keeps the
+    margin below best_loss for the negative cc and mi losses too. The first
+    epoch (best_loss still inf) always improves. Everything stays on the
+    device, so no host sync is needed.
+
+    Returns:
+        tuple: (best_loss, stale_epochs) tensors
+    """
+    improved = torch.isinf(best_loss) | (loss_value < best_loss - min_rel_improvement * best_loss.abs())
+    best_loss = torch.where(improved, loss_value, best_loss)
+    stale_epochs = torch.where(improved, torch.zeros_like(stale_epochs), stale_epochs + 1)
+    return best_loss, stale_epochs
+
+
 class Aligner:
     image_loss = MSELoss()
     nn_input_size = 64
     lr = 1e-6
     max_epochs = 5000
     device = "cuda"
+    # Early stopping: stop once the loss has not improved by min_rel_improvement
+    # for more than patience epochs (checked every convergence_check_every epochs)
+    patience = 200
+    min_rel_improvement = 1e-3
+    convergence_check_every = 50
 
     def __init__(self):
-        set_determinism(42)
+        deterministic_backends()
 
     def setLoss(self, loss):
         self.loss = loss
@@ -64,10 +89,16 @@ class Aligner:
         self.target, self.moving_meta = LoadImage(image_only=False)(fixed_file)
         self.target = EnsureChannelFirst()(self.target).to("cpu")
 
+    def _to_device(self, tensor):
+        # Stage CUDA uploads through pinned memory so the copy can run asynchronously
+        if torch.device(self.device).type == "cuda":
+            return tensor.pin_memory().to(self.device, non_blocking=True)
+        return tensor.to(self.device)
+
     def performAffine(self):
         SZ = self.nn_input_size
-        moving_ds = Resize(spatial_size=[SZ, SZ, SZ])(self.moving).to(self.device)
-        target_ds = Resize(spatial_size=[SZ, SZ, SZ])(self.target).to(self.device)
+        moving_ds = self._to_device(Resize(spatial_size=[SZ, SZ, SZ])(self.moving))
+        target_ds = self._to_device(Resize(spatial_size=[SZ, SZ, SZ])(self.target))
         moving_ds = ScaleIntensityRangePercentiles(
             lower=0.5, upper=99.5, b_min=0.0, b_max=10, clip=True
         )(moving_ds)
@@ -76,13 +107,14 @@ class Aligner:
         )(target_ds)
 
         # GlobalNet is a NN with Affine head
-        reg = GlobalNet(
+        # Weights are drawn from a fixed seed without touching other threads' generators
+        reg = seeded_build(lambda: GlobalNet(
             image_size=(SZ, SZ, SZ),
             spatial_dims=3,
             in_channels=2,  # moving and fixed
             num_channel_initial=2,
             depth=2,
-        ).to(self.device)
+        )).to(self.device)
 
         if USE_COMPILED:
             warp_layer = Warp(3, padding_mode="zeros").to(self.device)
@@ -92,15 +124,37 @@ class Aligner:
         reg.train()
         optimizerR = torch.optim.Adam(reg.parameters(), lr=1e-6)
 
+        # Mixed precision for the GlobalNet forward pass on CUDA; the warp and
+        # loss stay in FP32 because they are numerically sensitive
+        use_amp = torch.device(self.device).type == "cuda"
+        scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
+
+        # Inputs are constant across epochs, so build the batched tensors once
+        input_data = torch.cat((moving_ds, target_ds), dim=0).unsqueeze(0).contiguous()
+        moving_for_warp = moving_ds[None,]
+        target_for_loss = target_ds[None,]
+
+        # Convergence state lives on the device to avoid a host sync every epoch
+        best_loss = torch.tensor(float("inf"), device=self.device)
+        stale_epochs = torch.zeros((), dtype=torch.long, device=self.device)
+
         for epoch in range(self.max_epochs):
             optimizerR.zero_grad()
-            input_data = torch.cat((moving_ds, target_ds), dim=0)
-            input_data = input_data[None,]
-            ddf_ds = reg(input_data)
-            image_moved = warp_layer(moving_ds[None,], ddf_ds)
-            vol_loss = self.image_loss(image_moved, target_ds[None,])
-            vol_loss.backward()
-            optimizerR.step()
+            with torch.autocast("cuda", dtype=torch.float16, enabled=use_amp):
+                ddf_ds = reg(input_data)
+            ddf_ds = ddf_ds.float()
+            image_moved = warp_layer(moving_for_warp, ddf_ds)
+            vol_loss = self.image_loss(image_moved, target_for_loss)
+            scaler.scale(vol_loss).backward()
+            scaler.step(optimizerR)
+            scaler.update()
+
+            with torch.no_grad():
+                best_loss, stale_epochs = _update_convergence(vol_loss.detach(), best_loss, stale_epochs,
+                                                              self.min_rel_improvement)
+            if (epoch + 1) % self.convergence_check_every == 0 and stale_epochs.item() > self.patience:
+                print(f"\nConverged at epoch {epoch}: no improvement for {stale_epochs.item()} epochs")
+                break
             # Optimize: Print every 10 epochs and use .item() to reduce CPU overhead
             if epoch % 10 == 0 or epoch == self.max_epochs - 1:
                 print(
@@ -116,22 +170,26 @@ class Aligner:
                     end="\r",
                 )
 
+        # Release the training state before upsampling; detaching ddf_ds drops its
+        # autograd graph so the network activations can be freed
+        ddf_ds = ddf_ds.detach()
+        del input_data, image_moved, vol_loss, moving_for_warp, target_for_loss
+        reg.zero_grad(set_to_none=True)
+        del reg, optimizerR, scaler
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.empty_cache()
+
         size_moving = self.moving[0].shape
         size_target = self.target[0].shape
-        ddfx = (
-            Resize(spatial_size=size_target, mode="trilinear")(ddf_ds[:, 0])
-            * (size_moving[0] / SZ)
-        ).to("cpu")
-        ddfy = (
-            Resize(spatial_size=size_target, mode="trilinear")(ddf_ds[:, 1])
-            * (size_moving[1] / SZ)
-        ).to("cpu")
-        ddfz = (
-            Resize(spatial_size=size_target, mode="trilinear")(ddf_ds[:, 2])
-            * (size_moving[2] / SZ)
-        ).to("cpu")
-        self.ddf = torch.cat((ddfx, ddfy, ddfz), dim=0).to("cpu")
-        del ddf_ds, ddfx, ddfy, ddfz
+        # Upsample all three DDF channels in one call, then rescale each to moving voxels
+        ddf_up = F.interpolate(ddf_ds, size=tuple(size_target), mode="trilinear", align_corners=False)
+        scale = torch.tensor(
+            [size_moving[0] / SZ, size_moving[1] / SZ, size_moving[2] / SZ],
+            dtype=ddf_up.dtype,
+            device=ddf_up.device,
+        ).view(1, 3, 1, 1, 1)
+        self.ddf = (ddf_up * scale)[0].to("cpu")
+        del ddf_ds, ddf_up
 
     def saveDeformationField(self, ddf_file):
         nib.save(
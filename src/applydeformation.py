@@ -3,46 +3,58 @@ import numpy as np
 import argparse
 from scipy.ndimage import map_coordinates
 
+# CuPy is optional: when installed with a usable GPU, interpolation runs on the device
+try:
+    import cupy as cp
+    from cupyx.scipy.ndimage import map_coordinates as gpu_map_coordinates
+    _HAS_CUPY = cp.cuda.is_available()
+except ImportError:
+    _HAS_CUPY = False
+
 def load_nifti(file_path):
-    """Load a NIfTI file and return the image data as a numpy array along with the affine matrix."""
+    """Load a NIfTI file and return the image data as a float32 numpy array along with the affine matrix."""
     nifti_img = nib.load(file_path)
-    return nifti_img.get_fdata(), nifti_img.affine
+    # float32 is plenty for images and displacements and halves memory versus get_fdata
+    return np.asanyarray(nifti_img.dataobj, dtype=np.float32), nifti_img.affine
 
 def save_nifti(data, affine, output_path):
     """Save a numpy array as a NIfTI file."""
     nifti_img = nib.Nifti1Image(data, affine)
     nib.save(nifti_img, output_path)
 
+def map_coordinates_multi(images, coords, order=1, **kwargs):
+    """
+    Interpolate several same-shaped arrays at one set of coordinates.
+    Uses cupyx.scipy.ndimage.map_coordinates when CuPy is available, uploading
+    coords once for all images; otherwise falls back to scipy.
+    Returns a list of numpy arrays, one per input image.
+    """
+    if _HAS_CUPY:
+        coords_gpu = cp.asarray(coords)
+        return [gpu_map_coordinates(cp.asarray(img), coords_gpu, order=order, **kwargs).get() for img in images]
+    return [map_coordinates(img, coords, order=order, **kwargs) for img in images]
+
 def apply_deformation(image, def_field, affine,order=1):
     """
     Apply a deformation field to an image using nibabel and scipy.
     image should be a numpy array.
-    def_field should be a numpy array of shape (x, y, z, 3).
-    affine should be the affine matrix of the image.
+    def_field should be a numpy array of shape (x, y, z, 3) in voxel units.
+    affine is the affine matrix of the image; it is accepted for API
+    compatibility but not needed, since the displacements are in voxel units.
     """
     shape = image.shape
     
-    # Create a meshgrid of coordinates
-    coords = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
-    coords = np.stack(coords, axis=-1).astype(np.float64)
-    
-    # Get voxel dimensions from the affine matrix
-    voxel_dim = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
-    
-    ## Apply voxel dimensions to get real-world coordinates
-    #real_coords = coords * voxel_dim
-    
-    # Compute the displaced coordinates
-    displaced_coords = (coords + def_field) * voxel_dim
-    
-    # Convert real-world coordinates back to voxel coordinates
-    voxel_coords = displaced_coords / voxel_dim
+    # Build the displaced voxel coordinates directly in (3, x, y, z) layout
+    voxel_coords = np.empty((3,) + shape, dtype=np.float32)
+    voxel_coords[0] = np.arange(shape[0], dtype=np.float32)[:, None, None] + def_field[..., 0]
+    voxel_coords[1] = np.arange(shape[1], dtype=np.float32)[None, :, None] + def_field[..., 1]
+    voxel_coords[2] = np.arange(shape[2], dtype=np.float32)[None, None, :] + def_field[..., 2]
     
-    # Interpolate the image at the displaced coordinates
-    deformed_image = np.zeros_like(image)
-    #for i in range(shape[2]):
-    deformed_image = map_coordinates(image, voxel_coords.transpose(3, 0, 1, 2), order=order, mode='nearest')
-    #[..., [2, 1, 0]]
+    # Interpolate the image at the displaced coordinates. Spline prefiltering only
+    # matters for order > 1, so skip it (and its copy) for linear interpolation.
+    image32 = np.ascontiguousarray(image, dtype=np.float32)
+    deformed_image = map_coordinates_multi([image32], voxel_coords, order=order,
+                                           prefilter=order > 1, mode='nearest')[0]
     return deformed_image
 
 def applydeformation(image_path, def_path, output_path, order=1):
@@ -1,59 +1,64 @@
 import nibabel as nib
 import numpy as np
-from scipy.ndimage import map_coordinates
 import argparse
+import torch
+from torch.nn.functional import grid_sample
+from _grids import _coord_grid
 
 def load_nifti(file_path):
-    """Load a NIfTI file and return the image data as a numpy array along with the affine matrix."""
+    """Load a NIfTI file and return the image data as a float32 numpy array along with the affine matrix."""
     nifti_img = nib.load(file_path)
-    return nifti_img.get_fdata(), nifti_img.affine
+    # float32 is plenty for images and displacements and halves memory versus get_fdata
+    return np.asanyarray(nifti_img.dataobj, dtype=np.float32), nifti_img.affine
 
 def save_nifti(data, affine, output_path):
     """Save a numpy array as a NIfTI file."""
     nifti_img = nib.Nifti1Image(data, affine)
     nib.save(nifti_img, output_path)
 
-def compose_deformation_fields(def1, def2, affine1, affine2):
+def compose_deformation_fields(def1, def2, affine1, affine2, device=None):
     """
     Compose two deformation fields.
     def1 and def2 should be numpy arrays of shape (x, y, z, 3),
     where the last dimension contains the displacements.
+    All three components of def2 are resampled in a single grid_sample call,
+    on the GPU when available.
     """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
     # Get voxel dimensions from the affine matrices
     voxel_dim1 = np.sqrt(np.sum(affine1[:3, :3] ** 2, axis=0))
     voxel_dim2 = np.sqrt(np.sum(affine2[:3, :3] ** 2, axis=0))
     
     shape = def1.shape[:-1]
+    d1 = torch.from_numpy(np.ascontiguousarray(def1, dtype=np.float32)).to(device)
     
-    # Create a meshgrid of coordinates
-    coords = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
-    coords = np.stack(coords, axis=-1).astype(np.float64)
-
-    def1 = def1 * voxel_dim1
-    def2 = def2 * voxel_dim2
-
-    # Apply voxel dimensions to get real-world coordinates
-    real_coords1 = coords * voxel_dim1
-    real_coords2 = coords * voxel_dim2
+    # Position of each voxel after the first deformation, expressed in def2 voxel
+    # coordinates: (coords + def1) * voxel_dim1 / voxel_dim2
+    coords = _coord_grid(tuple(shape), device)
+    ratio = torch.tensor(voxel_dim1 / voxel_dim2, dtype=torch.float32, device=device)
+    new_voxel_coords2 = (coords + d1) * ratio
     
-    # Apply the first deformation field
-    new_real_coords1 = real_coords1 + def1
+    # Normalize to [-1, 1] over def2's grid, ordered z, y, x as grid_sample expects
+    scale = torch.tensor([2.0 / max(dim - 1, 1) for dim in def2.shape[:-1]], device=device)
+    grid = (new_voxel_coords2 * scale - 1)[None, ..., [2, 1, 0]]
     
-    # Convert real-world coordinates back to voxel coordinates for def2
-    new_voxel_coords2 = new_real_coords1 / voxel_dim2
-    
-    # Interpolate the second deformation field at the new voxel coordinates
-    composed_def = np.zeros_like(def1)
-    for i in range(3):
-        #composed_def[..., i] = map_coordinates(def2[..., i]*voxel_dim2[i], new_voxel_coords2[..., [2, 1, 0]].transpose(3, 0, 1, 2), order=1)
-        composed_def[..., i] = map_coordinates(def2[..., i], new_voxel_coords2.transpose(3, 0, 1, 2), order=1)
-
-    # Add the interpolated displacement to the new voxel coordinates
-    composed_def += def1
+    # Interpolate the second deformation field at the new voxel coordinates and add
+    # the first displacement, converting the mm-space sum back to def1 voxel units
+    d2 = torch.from_numpy(np.ascontiguousarray(def2, dtype=np.float32)).to(device)
+    sampled = grid_sample(d2.permute(3, 0, 1, 2)[None], grid, mode="bilinear",
+                          padding_mode="zeros", align_corners=True)
+    sampled = sampled[0].permute(1, 2, 3, 0)
+    # Match map_coordinates' constant mode: samples outside def2's grid are zero
+    upper = torch.tensor([dim - 1 for dim in def2.shape[:-1]], dtype=torch.float32, device=device)
+    inside = ((new_voxel_coords2 >= 0) & (new_voxel_coords2 <= upper)).all(dim=-1, keepdim=True)
+    sampled = sampled * inside
+    composed_def = sampled * torch.tensor(voxel_dim2 / voxel_dim1, dtype=torch.float32, device=device) + d1
     
-    return composed_def/voxel_dim1
+    return composed_def.cpu().numpy().astype(def1.dtype, copy=False)
 
-def composedeformation(def1_path, def2_path, output_path):
+def composedeformation(def1_path, def2_path, output_path, device=None):
     # Load deformation fields
     def1, affine1 = load_nifti(def1_path)
     def2, affine2 = load_nifti(def2_path)
@@ -63,7 +68,7 @@ def composedeformation(def1_path, def2_path, output_path):
         raise ValueError("Deformation fields must have the same shape")
 
     # Compose the deformation fields
-    composed_def = compose_deformation_fields(def1, def2, affine1, affine2)
+    composed_def = compose_deformation_fields(def1, def2, affine1, affine2, device=device)
 
     # Save the composed deformation field
     save_nifti(composed_def, affine1, output_path)
@@ -1,22 +1,166 @@
-import glob
 import os
+import zlib
+import importlib.util
 import torch
+import torch.nn.functional as F
 import nibabel as nib
 import numpy as np
 
-from monai.transforms import Rand3DElastic
-from monai.utils import InterpolateMode
-from monai.utils import set_determinism
-set_determinism(seed=42)
+from _grids import _coord_grid
+from utils import find_spectral_point_files
 
-def apply_nonlinear_deformation_to_nifti_files(nifti_dir, output_dir, sigma_range=None, magnitude_range=None):
+
+def _gaussian_kernels_1d(sigmas, device, radius=None):
+    """
+    Build one truncated 1D Gaussian kernel per sigma, zero-padded to a common length.
+    Kernels are truncated at 4 sigma and normalized to sum to 1. The common
+    radius defaults to that of the largest sigma; a larger fixed radius keeps
+    the kernel shape constant across batches.
+    Returns a (len(sigmas), 2 * radius + 1) tensor.
+    """
+    sigmas = torch.as_tensor(sigmas, dtype=torch.float32, device=device)
+    if radius is None:
+        radius = int(4.0 * float(sigmas.max()) + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=device)
+    kernels = torch.exp(-0.5 * (x[None] / sigmas[:, None]) ** 2)
+    truncate = (4.0 * sigmas + 0.5).floor()
+    kernels = kernels * (x[None].abs() <= truncate[:, None])
+    return kernels / kernels.sum(dim=1, keepdim=True)
+
+
+def _smooth_offsets(offsets, kernels):
+    """
+    Smooth random offsets of shape (B, 3, x, y, z) with a per-sample Gaussian.
+    The separable filter runs as three grouped conv3d passes over all B*3
+    channels at once, with zero padding at the volume edges, in the dtype
+    of offsets.
+    """
+    batch, channels = offsets.shape[:2]
+    radius = kernels.shape[1] // 2
+    kernels = kernels.to(offsets.dtype)
+    kernels = kernels.repeat_interleave(channels, dim=0)  # one kernel per (sample, component)
+    smoothed = offsets.reshape(1, batch * channels, *offsets.shape[2:])
+    for axis in range(3):
+        shape = [batch * channels, 1, 1, 1, 1]
+        shape[2 + axis] = kernels.shape[1]
+        padding = [0, 0, 0]
+        padding[axis] = radius
+        smoothed = F.conv3d(smoothed, kernels.reshape(shape), padding=tuple(padding),
+                            groups=batch * channels)
+    return smoothed.reshape(offsets.shape)
+
+
+def _warp_elastic(volumes, offsets, kernels, magnitudes, identity):
+    """
+    Smooth and scale the offsets and resample the volumes through them.
+    Takes tensors only, so it can be wrapped with torch.compile.
+    """
+    shape = volumes.shape[2:]
+    disp = _smooth_offsets(offsets, kernels).float() * magnitudes.reshape(-1, 1, 1, 1, 1)
+
+    grid = identity + disp.permute(0, 2, 3, 4, 1)
+    scale = torch.tensor([2.0 / max(dim - 1, 1) for dim in shape], device=volumes.device)
+    grid = (grid * scale - 1)[..., [2, 1, 0]]  # x, y, z -> z, y, x as grid_sample expects
+    return F.grid_sample(volumes, grid, mode="bilinear", padding_mode="border", align_corners=True)
+
+
+def elastic_deform_batch(volumes, offsets, sigmas, magnitudes, radius=None, warp_fn=_warp_elastic):
+    """
+    Warp a batch of volumes with smooth random displacement fields.
+    volumes has shape (B, 1, x, y, z) and offsets (B, 3, x, y, z) with values in [-1, 1].
+    Each offset field is Gaussian-smoothed with its sample's sigma (in voxels) and
+    scaled by its magnitude to give a displacement in voxels; all volumes are
+    then resampled in a single grid_sample call with border padding.
+    offsets may be float16: the smoothing then runs in half precision and the
+    field is promoted to float32 before it is scaled and sampled.
+    warp_fn may be a compiled version of _warp_elastic.
+    """
+    kernels = _gaussian_kernels_1d(sigmas, volumes.device, radius)
+    magnitudes = torch.as_tensor(magnitudes, dtype=torch.float32, device=volumes.device)
+    identity = _coord_grid(tuple(volumes.shape[2:]), volumes.device)
+    return warp_fn(volumes, offsets, kernels, magnitudes, identity)
+
+
+def _random_elastic_params(seed, shape, sigma_range, magnitude_range):
+    """Draw the offsets, magnitude and sigma for one volume from its own seeded generator."""
+    rng = np.random.RandomState(seed)
+    offsets = rng.uniform(-1.0, 1.0, (3,) + tuple(shape)).astype(np.float32)
+    magnitude = rng.uniform(magnitude_range[0], magnitude_range[1])
+    sigma = rng.uniform(sigma_range[0], sigma_range[1])
+    return offsets, magnitude, sigma
+
+
+def _save_deformed(nifti_file, output_dir, deformed_volume, affine, dtype):
+    """
+    Write one deformed volume in the source data type and return the output path.
+    Integer types are rounded and clipped to their range before the cast.
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        deformed_volume = np.clip(np.rint(deformed_volume), info.min, info.max)
+    deformed_volume = deformed_volume.astype(dtype, copy=False)
+    basename = os.path.basename(nifti_file)
+    output_file = os.path.join(output_dir, basename.replace(".nii.gz", "_deformed.nii.gz"))
+    deformed_img = nib.Nifti1Image(deformed_volume, affine)
+    # The constructor already stores affine as the sform, so only its code changes;
+    # the qform needs its one quaternion decomposition
+    deformed_img.set_sform(None, code=1)
+    deformed_img.set_qform(affine, code=1)
+    nib.save(deformed_img, output_file)
+    print(f"  ✅ Saved deformed volume to: {output_file}")
+    return output_file
+
+
+def _deform_batch(nifti_files, seeds, output_dir, sigma_range, magnitude_range, device, warp_fn=_warp_elastic):
+    """Deform a batch of same-shaped NIfTI files in one pass and return the output paths."""
+    volumes, offsets, magnitudes, sigmas, affines, dtypes = [], [], [], [], [], []
+    for nifti_file, seed in zip(nifti_files, seeds):
+        print(f"Processing: {nifti_file}")
+        img = nib.load(nifti_file, keep_file_open=True)
+        volume = np.asanyarray(img.dataobj, dtype=np.float32)
+        offset, magnitude, sigma = _random_elastic_params(seed, volume.shape, sigma_range, magnitude_range)
+        volumes.append(volume)
+        offsets.append(offset)
+        magnitudes.append(magnitude)
+        sigmas.append(sigma)
+        affines.append(img.affine)
+        # Scaled integer data is stored as float32, since the raw type cannot hold it
+        scaled = getattr(img.dataobj, 'slope', 1) != 1 or getattr(img.dataobj, 'inter', 0) != 0
+        dtypes.append(np.dtype(np.float32) if scaled else img.get_data_dtype())
+
+    volume_tensor = torch.from_numpy(np.stack(volumes)[:, None])
+    offset_tensor = torch.from_numpy(np.stack(offsets))
+    if device.type == "cuda":
+        # The offsets are heavily smoothed, so half precision is plenty for the
+        # field and halves its transfer and convolution bandwidth
+        offset_tensor = offset_tensor.half()
+        volume_tensor = volume_tensor.pin_memory().to(device, non_blocking=True)
+        offset_tensor = offset_tensor.pin_memory().to(device, non_blocking=True)
+
+    with torch.no_grad():
+        # Fixing the kernel radius from sigma_range keeps tensor shapes identical across batches
+        deformed = elastic_deform_batch(volume_tensor, offset_tensor, sigmas, magnitudes,
+                                        radius=int(4.0 * max(sigma_range) + 0.5), warp_fn=warp_fn)
+    deformed = deformed[:, 0].cpu().numpy()
+
+    return [_save_deformed(nifti_file, output_dir, deformed[i], affine, dtype)
+            for i, (nifti_file, affine, dtype) in enumerate(zip(nifti_files, affines, dtypes))]
+
+
+def apply_nonlinear_deformation_to_nifti_files(nifti_dir, output_dir, sigma_range=None, magnitude_range=None,
+                                               batch_size=8, compile_warp=True):
     """
     Apply random nonlinear deformation to all NIFTI files in a directory and save to a new directory.
+    Files are deformed in batches on the GPU when one is available. Each file gets
+    its own random field from a seed derived from its name, so results do not
+    depend on batch size.
     Args:
         nifti_dir (str): Directory containing NIFTI files
         output_dir (str): Directory to save deformed NIFTI files
         sigma_range (list): Controls smoothness of deformation
         magnitude_range (list): Controls magnitude of displacement
+        batch_size (int): Number of volumes deformed per call
+        compile_warp (bool): Compile the elastic warp with torch.compile on CUDA
     Returns:
         str: Path to the output directory containing deformed files
     """
@@ -25,36 +169,38 @@ def apply_nonlinear_deformation_to_nifti_files(nifti_dir, output_dir, sigma_rang
     if magnitude_range is None:
         magnitude_range = [100, 300]
     os.makedirs(output_dir, exist_ok=True)
-    nifti_files = sorted(glob.glob(f"{nifti_dir}/spectral_point_*.nii.gz"))
+    nifti_files = find_spectral_point_files(nifti_dir)
     print(f"\nFound {len(nifti_files)} NIFTI files to deform")
-    for nifti_file in nifti_files:
-        print(f"Processing: {nifti_file}")
-        img = nib.load(nifti_file)
-        volume = img.get_fdata()
-        affine = img.affine
-        original_dtype = volume.dtype  # Preserve original dtype
-        
-        # Convert to tensor - keep original dtype
-        volume_tensor = torch.from_numpy(volume).unsqueeze(0).unsqueeze(0)
-        
-        elastic_transform = Rand3DElastic(
-            sigma_range=sigma_range,
-            magnitude_range=magnitude_range,
-            prob=1.0,
-            mode=InterpolateMode.BILINEAR,
-            padding_mode="border", 
-        )
-        deformed_tensor = elastic_transform(volume_tensor[0])
-        deformed_volume = deformed_tensor.squeeze(0).numpy()
-        
-        # Restore original data type (MONAI may have changed it)
-        deformed_volume = deformed_volume.astype(original_dtype)
-        basename = os.path.basename(nifti_file)
-        output_file = os.path.join(output_dir, basename.replace(".nii.gz", "_deformed.nii.gz"))
-        deformed_img = nib.Nifti1Image(deformed_volume, affine)
-        deformed_img.set_sform(affine, code=1)
-        deformed_img.set_qform(affine, code=1)
-        nib.save(deformed_img, output_file)
-        print(f"  ✅ Saved deformed volume to: {output_file}")
+    if not nifti_files:
+        return output_dir
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seeds = [zlib.crc32(os.path.basename(f).encode()) for f in nifti_files]
+    
+    # Spectral points share one shape, so on the GPU the warp is compiled once for
+    # the batch shape (and once more for a shorter last batch). Inductor generates
+    # Triton kernels, so without Triton the warp runs eagerly from the start.
+    warp_fn = _warp_elastic
+    compile_errors = ()
+    if compile_warp and device.type == "cuda":
+        if importlib.util.find_spec("triton") is None:
+            print("WARNING: Triton is not installed; running the elastic warp in eager mode")
+        else:
+            from torch._dynamo.exc import BackendCompilerFailed
+            warp_fn = torch.compile(_warp_elastic, mode="max-autotune", dynamic=False)
+            compile_errors = BackendCompilerFailed
+    
+    for start in range(0, len(nifti_files), batch_size):
+        batch = (nifti_files[start:start + batch_size], seeds[start:start + batch_size],
+                 output_dir, sigma_range, magnitude_range, device)
+        # Only a failure to compile falls back; runtime errors such as CUDA OOM
+        # or shape bugs propagate
+        try:
+            _deform_batch(*batch, warp_fn=warp_fn)
+        except compile_errors as e:
+            print(f"WARNING: compiling the elastic warp failed ({e}); falling back to eager mode")
+            warp_fn = _warp_elastic
+            compile_errors = ()
+            _deform_batch(*batch, warp_fn=warp_fn)
     print(f"\n✅ Applied nonlinear deformation to all {len(nifti_files)} files\n")
     return output_dir
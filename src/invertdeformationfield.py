@@ -1,60 +1,59 @@
 import nibabel as nib
 import numpy as np
-from scipy.interpolate import griddata
 import argparse
-from tqdm import tqdm
+import torch
+from torch.nn.functional import grid_sample
+from _grids import _coord_grid
 
 def load_nifti(file_path):
-    """Load a NIfTI file and return the image data as a numpy array along with the affine matrix."""
+    """Load a NIfTI file and return the image data as a float32 numpy array along with the affine matrix."""
     nifti_img = nib.load(file_path)
-    return nifti_img.get_fdata(), nifti_img.affine
+    # float32 is plenty for images and displacements and halves memory versus get_fdata
+    return np.asanyarray(nifti_img.dataobj, dtype=np.float32), nifti_img.affine
 
 def save_nifti(data, affine, output_path):
     """Save a numpy array as a NIfTI file."""
     nifti_img = nib.Nifti1Image(data, affine)
     nib.save(nifti_img, output_path)
 
-def invert_deformation_field(def_field, affine):
+def invert_deformation_field(def_field, affine, num_iterations=15, device=None):
     """
-    Invert a deformation field using scattered interpolation.
-    def_field should be a numpy array of shape (x, y, z, 3).
+    Invert a deformation field using fixed-point iteration.
+    def_field should be a numpy array of shape (x, y, z, 3) in voxel units.
+    The inverse u satisfies u(y) = -v(y + u(y)); it is found by iterating
+    u_{k+1}(y) = -v(y + u_k(y)) with trilinear resampling of v on the device.
+    The affine is accepted for API compatibility; working in voxel units
+    needs no voxel-size scaling.
     """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
     shape = def_field.shape[:-1]
-    
-    # Create a meshgrid of coordinates
-    coords = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
-    coords = np.stack(coords, axis=-1).reshape(-1, 3)
-    
-    # Get voxel dimensions from the affine matrix
-    voxel_dim = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
-    def_field *= voxel_dim
-    # Apply voxel dimensions to get real-world coordinates
-    real_coords = coords * voxel_dim
-    
-    # Compute the displaced coordinates
-    displaced_coords = real_coords + def_field.reshape(-1, 3)
-    
-    # Initialize the inverse deformation field
-    inv_def = np.zeros_like(def_field).reshape(-1, 3)
-    
-    # Perform scattered interpolation for each displacement component
-    inv_def = griddata(displaced_coords, real_coords.reshape(-1, 3), real_coords, method='linear', fill_value=0)
-    inv_def = inv_def.reshape(real_coords.shape)
-    """
-    for i in tqdm(range(3)):
-        inv_def[:, i] = griddata(displaced_coords, real_coords[:, i], real_coords, method='linear', fill_value=0)
-    
-    """
-    inv_def -= real_coords
-    
-    return inv_def.reshape(def_field.shape) / voxel_dim
 
-def invertdeformationfield(def_path, output_path):
+    # (1, 3, x, y, z) displacement tensor
+    v = torch.from_numpy(np.ascontiguousarray(def_field, dtype=np.float32))
+    v = v.permute(3, 0, 1, 2)[None].to(device)
+
+    # Identity grid normalized to [-1, 1], with per-axis scale to map voxel displacements
+    ref_grid = _coord_grid(tuple(shape), device)[None]
+    scale = torch.tensor([2.0 / max(dim - 1, 1) for dim in shape], device=device)
+    ref_grid = ref_grid * scale - 1
+
+    u = -v
+    for _ in range(num_iterations):
+        grid = ref_grid + u.permute(0, 2, 3, 4, 1) * scale
+        grid = grid[..., [2, 1, 0]]  # x, y, z -> z, y, x as grid_sample expects
+        u = -grid_sample(v, grid, mode="bilinear", padding_mode="border", align_corners=True)
+
+    inv_def = u[0].permute(1, 2, 3, 0).cpu().numpy()
+    return inv_def.astype(def_field.dtype, copy=False)
+
+def invertdeformationfield(def_path, output_path, device=None):
     # Load deformation field
     def_field, affine = load_nifti(def_path)
     
     # Invert the deformation field
-    inv_def = invert_deformation_field(def_field, affine)
+    inv_def = invert_deformation_field(def_field, affine, device=device)
     
     # Save the inverted deformation field
     save_nifti(inv_def, affine, output_path)
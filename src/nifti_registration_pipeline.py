@@ -2,16 +2,256 @@
 # Independent of hardcoded paths, TE values, or b-values
 
 import os
-import glob
+import shutil
+import fnmatch
+import hashlib
 import argparse
+import collections
+import itertools
+import queue
+import subprocess
+import tempfile
+import threading
 import numpy as np
 import nibabel as nib
+import SimpleITK as sitk
 from registration import perform_nonlinear_registration
-from multiprocessing import Pool
+from utils import available_memory_bytes
+from aligner import Aligner
+from warper import Warper
+import torch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
-def generate_average_template(input_files, output_path):
-    """Generate average template from multiple NIfTI files."""
+def _load_volume_float32(filepath, shape=None):
+    """
+    Read a NIfTI volume straight into float32, skipping get_fdata's float64 copy.
+    Each volume is read once in full, so uncompressed files are read directly
+    rather than memory-mapped.
+    With shape, the header is checked first and None is returned on a mismatch
+    without reading any voxel data.
+    """
+    img = nib.load(filepath, mmap=False, keep_file_open=True)
+    if shape is not None and img.shape != tuple(shape):
+        return None
+    return np.asanyarray(img.dataobj, dtype=np.float32)
+
+
+def _map_volume(filepath, shape):
+    """
+    Return an uncompressed, unscaled .nii volume as a read-only memory map of its
+    stored data, so it is converted to float32 slab by slab as it is summed
+    instead of being copied whole into RAM. Other volumes, and stored types
+    that float32 cannot hold exactly, are read with _load_volume_float32.
+    Returns None on a shape mismatch.
+    """
+    if filepath.endswith('.nii'):
+        img = nib.load(filepath, mmap='r')
+        if img.shape != tuple(shape):
+            return None
+        proxy = img.dataobj
+        if (proxy.slope == 1 and proxy.inter == 0
+                and np.can_cast(img.get_data_dtype(), np.float32, casting='safe')):
+            data = np.asanyarray(proxy)
+            if isinstance(data, np.memmap):
+                return data
+    return _load_volume_float32(filepath, shape)
+
+
+# Numba is optional: when installed, slabs are accumulated by a multithreaded kernel
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _accumulate_kernel(dst, src):
+        for i in prange(dst.size):
+            dst[i] += src[i]
+except ImportError:
+    _accumulate_kernel = None
+
+
+# Accumulator bytes touched per tile; sized to stay resident in a typical L2/L3 cache
+TILE_BYTES = 8 * 1024 * 1024
+
+
+def _add_inplace(dst, src):
+    """Add src into dst in place, with the Numba kernel when both share a contiguous layout."""
+    if (_accumulate_kernel is not None and dst.dtype == src.dtype
+            and dst.flags['F_CONTIGUOUS'] and src.flags['F_CONTIGUOUS']):
+        _accumulate_kernel(dst.ravel(order='K'), src.ravel(order='K'))
+    else:
+        np.add(dst, src, out=dst)
+
+
+def _slab_ranges(shape, itemsize):
+    """Split the last axis into (start, stop) slabs of about TILE_BYTES each."""
+    plane_bytes = max(int(np.prod(shape[:-1])) * itemsize, 1)
+    slab = max(1, TILE_BYTES // plane_bytes)
+    return [(start, min(start + slab, shape[-1])) for start in range(0, shape[-1], slab)]
+
+
+def _accumulate_tiled(volume_sum, volumes, executor=None):
+    """
+    Add a group of volumes into volume_sum one slab (along the last axis) at a time.
+    NIfTI data is Fortran-ordered, so last-axis slabs are contiguous in both the
+    accumulator and the volumes. Each accumulator slab stays in cache while every
+    volume in the group is added to it, instead of streaming the whole accumulator
+    through memory per volume. Volumes are added in list order, so the result
+    matches adding them one by one.
+    With an executor, slabs are summed concurrently; they are disjoint, so the
+    threads share the accumulator without locking.
+    """
+    if not volumes:
+        return
+
+    def add_slab(bounds):
+        start, stop = bounds
+        acc = volume_sum[..., start:stop]
+        for data in volumes:
+            _add_inplace(acc, data[..., start:stop])
+
+    slabs = _slab_ranges(volume_sum.shape, volume_sum.itemsize)
+    if executor is None:
+        for bounds in slabs:
+            add_slab(bounds)
+    else:
+        list(executor.map(add_slab, slabs))
+
+
+def _bounded_map(executor, fn, items, max_in_flight):
+    """
+    Like executor.map(fn, items), but with at most max_in_flight calls submitted
+    and not yet consumed, so results are produced only as fast as they are used.
+    """
+    items = iter(items)
+    in_flight = collections.deque()
+    for item in itertools.islice(items, max_in_flight):
+        in_flight.append(executor.submit(fn, item))
+    while in_flight:
+        result = in_flight.popleft().result()
+        for item in itertools.islice(items, 1):
+            in_flight.append(executor.submit(fn, item))
+        yield result
+
+
+def _sum_streaming(input_files, shape, accumulator_dir, max_workers, group_size):
+    """
+    Sum volumes into a float32 memmap, group_size volumes at a time.
+    The memmap is backed by an anonymous temporary file in accumulator_dir, so
+    peak RAM stays near a few input volumes however large the template; the
+    file's space is released once the returned map is dropped. Uncompressed
+    inputs are memory-mapped too (see _map_volume) and served from the page
+    cache on repeated runs.
+    Returns the sum and the number of volumes added.
+    """
+    with tempfile.TemporaryFile(dir=accumulator_dir) as accumulator_file:
+        volume_sum = np.memmap(accumulator_file, dtype=np.float32, mode='w+', shape=shape, order='F')
+    valid_count = 0
+    pending = []
+    
+    # Accumulate all volumes while one pool reads ahead and another sums slabs;
+    # read-ahead is bounded so decoded volumes never pile up beyond what is summed
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            ThreadPoolExecutor(max_workers=max_workers) as summer:
+        volumes = _bounded_map(executor, lambda filepath: _map_volume(filepath, shape),
+                               input_files, 2 * max_workers)
+        for i, (filepath, data) in enumerate(zip(input_files, volumes)):
+            print(f"  Processing volume {i+1}/{len(input_files)}")
+            
+            # Mismatched dimensions are caught from the header, before any read
+            if data is None:
+                print(f"  Skipping {filepath} (dimension mismatch)")
+                continue
+                
+            # Add to accumulator once a full group has been read
+            pending.append(data)
+            valid_count += 1
+            if len(pending) == group_size:
+                _accumulate_tiled(volume_sum, pending, summer)
+                pending = []
+        _accumulate_tiled(volume_sum, pending, summer)
+    return volume_sum, valid_count
+
+
+def _sum_stacked(input_files, shape, max_workers):
+    """
+    Read all volumes into one (N, x, y, z) float32 stack in parallel and reduce
+    it over the stack axis, one last-axis slab per thread.
+    Returns the sum and the number of volumes added.
+    """
+    stack = np.empty((len(input_files),) + tuple(shape), dtype=np.float32)
+    
+    def fill(i):
+        data = _load_volume_float32(input_files[i], shape)
+        if data is None:
+            return False
+        stack[i] = data
+        return True
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        valid = list(executor.map(fill, range(len(input_files))))
+        for i, (filepath, ok) in enumerate(zip(input_files, valid)):
+            print(f"  Processing volume {i+1}/{len(input_files)}")
+            if not ok:
+                print(f"  Skipping {filepath} (dimension mismatch)")
+        
+        # Move valid volumes down over skipped ones in place; a boolean index
+        # would copy the whole stack
+        valid_count = 0
+        for i, ok in enumerate(valid):
+            if ok:
+                if i != valid_count:
+                    stack[valid_count] = stack[i]
+                valid_count += 1
+        stack = stack[:valid_count]
+        volume_sum = np.empty(shape, dtype=np.float32)
+        
+        def reduce_slab(bounds):
+            start, stop = bounds
+            np.sum(stack[..., start:stop], axis=0, out=volume_sum[..., start:stop])
+        
+        list(executor.map(reduce_slab, _slab_ranges(shape, stack.itemsize * len(stack))))
+    return volume_sum, len(stack)
+
+
+def _save_nifti(img, output_path):
+    """
+    Save img, compressing .nii.gz outputs with pigz when it is on the PATH.
+    nibabel gzips on a single thread; pigz compresses the uncompressed file
+    in parallel. Without pigz, or if it fails, nib.save writes the file.
+    """
+    pigz = shutil.which('pigz')
+    if not output_path.endswith('.nii.gz') or pigz is None:
+        nib.save(img, output_path)
+        return
+    fd, raw_path = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(output_path)))
+    os.close(fd)
+    try:
+        nib.save(img, raw_path)
+        with open(output_path, 'wb') as out:
+            subprocess.run([pigz, '-c', raw_path], stdout=out, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        nib.save(img, output_path)
+    finally:
+        os.unlink(raw_path)
+
+
+def generate_average_template(input_files, output_path, max_workers=8, group_size=4,
+                              stack_budget_bytes=None):
+    """
+    Generate average template from multiple NIfTI files.
+    When all volumes and the sum fit in stack_budget_bytes (by default half
+    the available memory) they are read in parallel into one 4D stack and reduced over it.
+    Otherwise a thread pool reads ahead while the volumes are summed into a
+    memory-mapped float32 accumulator in input order, group_size volumes at a
+    time with cache-sized tiles. Either way the sum is split into last-axis
+    slabs reduced by max_workers threads; NumPy releases the GIL for the
+    arithmetic, so this scales like a process pool without copying volumes
+    between processes.
+    .nii.gz inputs are decompressed with indexed_gzip when it is installed
+    (pip install indexed_gzip); nibabel uses it automatically for files
+    opened with keep_file_open=True, as they are here.
+    """
     print(f"Generating average template from {len(input_files)} volumes...")
     
     if not input_files:
@@ -22,49 +262,35 @@ def generate_average_template(input_files, output_path):
         import nibabel as nib
         import numpy as np
         
-        # Load first volume to get dimensions and affine
-        first_img = nib.load(input_files[0])
-        first_data = first_img.get_fdata()
+        # Read dimensions and affine from the first header; its data is read with the rest
+        first_img = nib.load(input_files[0], keep_file_open=True)
+        shape = first_img.shape
         first_affine = first_img.affine
         first_header = first_img.header
         
-        print(f"Template dimensions: {first_data.shape}")
-        
-        # Initialize accumulator
-        volume_sum = np.zeros_like(first_data, dtype=np.float64)
-        valid_count = 0
+        print(f"Template dimensions: {shape}")
         
-        # Accumulate all volumes
-        for i, filepath in enumerate(input_files):
-            print(f"  Processing volume {i+1}/{len(input_files)}")
-            
-            img = nib.load(filepath)
-            data = img.get_fdata()
-            
-            # Check dimensions match
-            if data.shape != first_data.shape:
-                print(f"  Skipping {filepath} (dimension mismatch)")
-                continue
-                
-            # Add to accumulator
-            volume_sum += data.astype(np.float64)
-            valid_count += 1
+        if stack_budget_bytes is None:
+            stack_budget_bytes = available_memory_bytes() // 2
+        # The stacked path holds every volume plus the float32 sum
+        if (len(input_files) + 1) * int(np.prod(shape)) * np.dtype(np.float32).itemsize <= stack_budget_bytes:
+            volume_sum, valid_count = _sum_stacked(input_files, shape, max_workers)
+        else:
+            volume_sum, valid_count = _sum_streaming(input_files, shape,
+                                                     os.path.dirname(os.path.abspath(output_path)),
+                                                     max_workers, group_size)
         
         if valid_count == 0:
             print("ERROR: No valid volumes found")
             return False
         
         # Calculate average
-        average_volume = volume_sum / valid_count
+        average_volume = np.divide(volume_sum, valid_count, out=volume_sum)
         print(f"Averaged {valid_count} volumes")
         
-        # Convert back to original data type
-        if first_data.dtype != np.float64:
-            average_volume = average_volume.astype(first_data.dtype)
-        
-        # Save average template
+        # Save average template; the first header's data type sets the stored type
         avg_img = nib.Nifti1Image(average_volume, first_affine, first_header)
-        nib.save(avg_img, output_path)
+        _save_nifti(avg_img, output_path)
         print(f"✅ Average template saved: {output_path}")
         return True
         
@@ -73,8 +299,25 @@ def generate_average_template(input_files, output_path):
         return False
 
 
+def _nifti_extension(path):
+    """Return '.nii.gz', '.nii' or the plain extension of path."""
+    return '.nii.gz' if path.endswith('.nii.gz') else os.path.splitext(path)[1]
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copying the bytes when linking is not possible."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
 def generate_central_template(input_files, output_path):
-    """Generate template using central (middle) volume."""
+    """
+    Generate template using central (middle) volume.
+    When output_path has the same format as the central file, the file is
+    hardlinked (or copied) without decoding; otherwise it is converted.
+    """
     if not input_files:
         print("ERROR: No input files provided")
         return False
@@ -91,8 +334,10 @@ def generate_central_template(input_files, output_path):
         print(f"  (Volume {central_index + 1} of {len(sorted_files)} sorted files)")
         
         # Copy central file to output
-        img = nib.load(central_file)
-        nib.save(img, output_path)
+        if _nifti_extension(central_file) == _nifti_extension(output_path):
+            _link_or_copy(central_file, output_path)
+        else:
+            nib.save(nib.load(central_file, keep_file_open=True), output_path)
         print(f"✅ Central template saved: {output_path}")
         return True
         
@@ -101,28 +346,83 @@ def generate_central_template(input_files, output_path):
         return False
 
 
-def register_single_nifti_file(args):
+def _registered_output_path(input_file, output_dir):
+    """Generate output filename by adding .reg before the extension."""
+    basename = os.path.basename(input_file)
+    if basename.endswith('.nii.gz'):
+        output_name = basename.replace('.nii.gz', '.reg.nii.gz')
+    elif basename.endswith('.nii'):
+        output_name = basename.replace('.nii', '.reg.nii')
+    else:
+        output_name = basename + '.reg'
+    return os.path.join(output_dir, output_name)
+
+
+def _prefetch_moving_images(indexed_args, depth=2):
+    """
+    Yield (index, args, moving_image) for each (index, args) pair while a
+    background thread reads ahead. The index travels with the item, so the
+    consumer iterates this generator to its end and never stops early.
+    Up to depth images are read from disk while the current one registers.
+    The image is None when the read failed; register_single_nifti_file then
+    reports the file as usual. Any other error in the reader thread is
+    re-raised here once the images read before it have been yielded.
+    """
+    prefetched = queue.Queue(maxsize=depth)
+    producer_error = []
+
+    def producer():
+        try:
+            for i, args in indexed_args:
+                try:
+                    moving_image = sitk.ReadImage(args[0], sitk.sitkFloat32)
+                except RuntimeError:
+                    moving_image = None
+                prefetched.put((i, args, moving_image))
+        except BaseException as e:
+            producer_error.append(e)
+        finally:
+            # Always end the stream so the consumer cannot block forever
+            prefetched.put(None)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while (item := prefetched.get()) is not None:
+        yield item
+    if producer_error:
+        raise producer_error[0]
+
+
+# Aligner and Warper keep per-call state, so each worker thread gets its own pair
+_thread_models = threading.local()
+
+
+def _registration_models():
+    """Return this thread's (Aligner, Warper), creating them on first use."""
+    if not hasattr(_thread_models, 'aligner'):
+        _thread_models.aligner = Aligner()
+        _thread_models.nonlin_reg = Warper()
+    return _thread_models.aligner, _thread_models.nonlin_reg
+
+
+def register_single_nifti_file(args, moving_image=None, fixed_image=None):
     """
     Process a single file for registration
+    The caller skips files whose output already exists (see _split_existing_outputs).
     
     Args:
-        args: Tuple of (input_file, template, output_dir)
+        args: Tuple of (input_file, template, output_dir, atomic_write). With
+            atomic_write, the result is written to a per-process temporary file
+            and renamed into place so parallel workers never see partial output.
+        moving_image: Optional SimpleITK image of input_file, already read
+        fixed_image: Optional SimpleITK image of the template, shared by all files
         
     Returns:
         Dict with processing results
     """
-    input_file, template, output_dir = args
-    
-    # Generate output filename by adding .reg before the extension
-    basename = os.path.basename(input_file)
-    if basename.endswith('.nii.gz'):
-        output_name = basename.replace('.nii.gz', '.reg.nii.gz')
-    elif basename.endswith('.nii'):
-        output_name = basename.replace('.nii', '.reg.nii')
-    else:
-        output_name = basename + '.reg'
+    input_file, template, output_dir, atomic_write = args
     
-    output_file = os.path.join(output_dir, output_name)
+    output_file = _registered_output_path(input_file, output_dir)
+    output_name = os.path.basename(output_file)
     
     result = {
         'input_file': input_file,
@@ -131,73 +431,116 @@ def register_single_nifti_file(args):
         'message': ''
     }
     
-    # Check if input file exists
-    if not os.path.exists(input_file):
-        result['message'] = f"Input file does not exist: {input_file}"
-        return result
-    
-    # Check if output already exists (with atomic check to avoid race conditions)
-    import fcntl
-    import tempfile
-    
-    try:
-        # Try to create a lock file atomically
-        lock_file = output_file + '.lock'
-        with open(lock_file, 'x') as lock:
-            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            
-            if os.path.exists(output_file):
-                result['message'] = f"Output file already exists, skipping: {output_file}"
-                result['success'] = True
-                os.unlink(lock_file)  # Clean up lock file
-                return result
-    except (FileExistsError, BlockingIOError):
-        # Another process is handling this file or file already exists
-        result['message'] = f"File being processed by another worker or already exists: {output_file}"
-        result['success'] = True
-        return result
+    # Hidden per-process name keeps the extension so the writer picks the same format
+    if atomic_write:
+        target_file = os.path.join(output_dir, f".{os.getpid()}.{output_name}")
+    else:
+        target_file = output_file
     
     try:
-        # Perform registration
-        perform_nonlinear_registration(
+        # Perform registration; it returns True once the output has been written
+        aligner, nonlin_reg = _registration_models()
+        if perform_nonlinear_registration(
             moving=input_file,
             fixed=template,
-            output=output_file,
-        )
-        
-        # Verify output was created
-        if os.path.exists(output_file):
+            output=target_file,
+            moving_image=moving_image,
+            fixed_image=fixed_image,
+            aligner=aligner,
+            nonlin_reg=nonlin_reg,
+        ):
+            if atomic_write:
+                os.replace(target_file, output_file)
             result['success'] = True
             result['message'] = f"Successfully registered: {output_file}"
-            # Clean up lock file
-            lock_file = output_file + '.lock'
-            if os.path.exists(lock_file):
-                try:
-                    os.unlink(lock_file)
-                except OSError:
-                    pass  # Lock file might already be cleaned up
         else:
             result['message'] = f"Registration failed - output file not created: {output_file}"
-            # Clean up lock file on failure
-            lock_file = output_file + '.lock'
-            if os.path.exists(lock_file):
-                try:
-                    os.unlink(lock_file)
-                except OSError:
-                    pass
             
     except Exception as e:
         result['message'] = f"Registration error: {str(e)}"
-        # Clean up lock file on exception
-        lock_file = output_file + '.lock'
-        if os.path.exists(lock_file):
-            try:
-                os.unlink(lock_file)
-            except OSError:
-                pass
+    
+    # Drop any partial per-process output left by a failed registration
+    if atomic_write and not result['success']:
+        try:
+            os.unlink(target_file)
+        except OSError:
+            pass
     
     return result
 
+def _split_existing_outputs(input_files, output_dir):
+    """
+    Separate files whose registered output already exists, with one listing of output_dir.
+    Returns (indices of the files still to register, {index: skip result}).
+    """
+    with os.scandir(output_dir) as it:
+        existing = {entry.name for entry in it}
+    pending, skipped = [], {}
+    for i, input_file in enumerate(input_files):
+        output_file = _registered_output_path(input_file, output_dir)
+        if os.path.basename(output_file) in existing:
+            skipped[i] = {
+                'input_file': input_file,
+                'output_file': output_file,
+                'success': True,
+                'message': f"Output file already exists, skipping: {output_file}"
+            }
+        else:
+            pending.append(i)
+    return pending, skipped
+
+
+def _list_input_files(input_dir, file_pattern):
+    """
+    List files in input_dir whose names match file_pattern in one os.scandir pass.
+    Like glob, hidden files are skipped unless the pattern starts with a dot.
+    Returns (matching files, matching files without .reg.nii.gz outputs), sorted.
+    """
+    with os.scandir(input_dir) as it:
+        matches = sorted(
+            entry.path for entry in it
+            if entry.is_file() and fnmatch.fnmatch(entry.name, file_pattern)
+            and (file_pattern.startswith('.') or not entry.name.startswith('.'))
+        )
+    return matches, [f for f in matches if not f.endswith('.reg.nii.gz')]
+
+
+# Each registration worker thread keeps one GPU and one CUDA stream for its lifetime
+_thread_device = threading.local()
+
+
+def _pin_worker_thread(gpu_slots):
+    """Executor initializer: take this worker thread's GPU from gpu_slots and create its stream."""
+    _thread_device.gpu_id = gpu_slots.get_nowait()
+    _thread_device.stream = torch.cuda.Stream(device=_thread_device.gpu_id)
+
+
+def _register_on_worker(args, fixed_image=None):
+    """
+    Register one file in the calling worker thread.
+    A thread pinned by _pin_worker_thread runs on its GPU and its own CUDA
+    stream, so workers share one process and CUDA context instead of forking.
+    """
+    if not hasattr(_thread_device, 'gpu_id'):
+        return register_single_nifti_file(args, fixed_image=fixed_image)
+    with torch.cuda.device(_thread_device.gpu_id), torch.cuda.stream(_thread_device.stream):
+        return register_single_nifti_file(args, fixed_image=fixed_image)
+
+
+def _record_result(results, result):
+    """Classify one file result into the summary counts and report it."""
+    if result['success']:
+        if "already exists" in result['message']:
+            results['skipped'] += 1
+        else:
+            results['successful'] += 1
+            print(f"✅ {result['message']}")
+    else:
+        results['failed'] += 1
+        results['errors'].append(result['message'])
+        print(f"❌ {result['message']}")
+
+
 def register_nifti_directory(input_dir, template, output_dir, 
                                  file_pattern="*.nii.gz", num_processes=4, template_strategy="average"):
     """
@@ -208,7 +551,7 @@ def register_nifti_directory(input_dir, template, output_dir,
         template: Template file for registration (if None, generates based on strategy)
         output_dir: Output directory for registered files
         file_pattern: Pattern to match input files (default: "*.nii.gz")
-        num_processes: Number of parallel processes
+        num_processes: Number of parallel workers (threads, spread across GPUs)
         template_strategy: Strategy for auto-template generation ("average", "central", "specified")
         
     Returns:
@@ -220,6 +563,9 @@ def register_nifti_directory(input_dir, template, output_dir,
         print(f"ERROR: Input directory {input_dir} does not exist.")
         return None
 
+    # List the input directory once for both template generation and registration
+    matching_files, input_files = _list_input_files(input_dir, file_pattern)
+    
     # Auto-generate template if not provided
     if template is None:
         if template_strategy == "specified":
@@ -228,23 +574,45 @@ def register_nifti_directory(input_dir, template, output_dir,
             
         print(f"No template specified, generating {template_strategy} template from input directory...")
         
-        # Find all matching NIfTI files for template generation
-        template_pattern = os.path.join(input_dir, file_pattern)
-        template_candidates = glob.glob(template_pattern)
-        template_candidates = [f for f in template_candidates if not f.endswith('.reg.nii.gz')]
+        # All matching NIfTI files are used for template generation
+        template_candidates = input_files
         
         if not template_candidates:
             print(f"ERROR: No files found for template generation in {input_dir}")
             return None
         
-        # Generate template based on strategy
-        template = os.path.join(output_dir, f"auto_generated_template_{template_strategy}.nii.gz")
+        # Generate template based on strategy, keyed by the inputs' names and mtimes
+        # so an unchanged input set reuses the template from a previous run. The
+        # template stays next to the outputs, so it is written uncompressed: gzip
+        # dominates the save time and every registration re-reads it. A central
+        # template keeps its source's format so it can be linked without decoding.
+        template_key = hashlib.sha1(repr(sorted(
+            (f, os.path.getmtime(f)) for f in template_candidates)).encode()).hexdigest()[:12]
+        template_ext = '.nii'
+        if template_strategy == "central":
+            template_ext = _nifti_extension(sorted(template_candidates)[len(template_candidates) // 2])
+        template = os.path.join(output_dir,
+                                f"auto_generated_template_{template_strategy}_{template_key}{template_ext}")
         os.makedirs(output_dir, exist_ok=True)
         
-        if template_strategy == "average":
-            success = generate_average_template(template_candidates, template)
-        elif template_strategy == "central":
-            success = generate_central_template(template_candidates, template)
+        # The template is written under a hidden per-process name and renamed
+        # into place, so an interrupted run never leaves a truncated template
+        # that a later run would reuse
+        partial_template = os.path.join(output_dir, f".{os.getpid()}.{os.path.basename(template)}")
+        if os.path.exists(template):
+            print(f"Reusing existing {template_strategy} template: {template}")
+            success = True
+        elif template_strategy in ("average", "central"):
+            generate = generate_average_template if template_strategy == "average" else generate_central_template
+            try:
+                success = generate(template_candidates, partial_template)
+                if success:
+                    os.replace(partial_template, template)
+            finally:
+                try:
+                    os.unlink(partial_template)
+                except OSError:
+                    pass
         else:
             print(f"ERROR: Unsupported template strategy: {template_strategy}")
             return None
@@ -260,26 +628,17 @@ def register_nifti_directory(input_dir, template, output_dir,
         return None    # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     
-    # Find all matching NIfTI files
-    input_pattern = os.path.join(input_dir, file_pattern)
-    input_files = glob.glob(input_pattern)
-    
-    if not input_files:
-        print(f"ERROR: No files found matching pattern: {input_pattern}")
+    if not matching_files:
+        print(f"ERROR: No files found matching pattern: {os.path.join(input_dir, file_pattern)}")
         return None
     
-    # Filter out already processed files (those ending with .reg.nii.gz)
-    input_files = [f for f in input_files if not f.endswith('.reg.nii.gz')]
-    
     print(f"Found {len(input_files)} input files to process")
     print(f"Template: {template}")
-    print(f"Using {num_processes} parallel processes")
+    print(f"Using {num_processes} worker thread(s)")
     
-    # Prepare arguments for parallel processing
-    process_args = [
-        (input_file, template, output_dir)
-        for input_file in input_files
-    ]
+    # Arguments are built per file as work is dispatched
+    # Sequential runs write outputs directly; parallel workers rename into place
+    atomic_write = num_processes > 1
     
     # Process files in parallel
     results = {
@@ -287,7 +646,7 @@ def register_nifti_directory(input_dir, template, output_dir,
         'template': template,
         'output_dir': output_dir,
         'file_pattern': file_pattern,
-        'total_files': len(process_args),
+        'total_files': len(input_files),
         'successful': 0,
         'skipped': 0,
         'failed': 0,
@@ -295,33 +654,57 @@ def register_nifti_directory(input_dir, template, output_dir,
         'file_results': []
     }
     
-    # OPTIMIZATION: Bypass multiprocessing Pool when using single process
-    # This eliminates ALL multiprocessing overhead for 35x speedup
+    # Existing outputs are skipped here, so workers never touch them
+    pending, skipped = _split_existing_outputs(input_files, output_dir)
+    file_results = [None] * len(input_files)
+    for i, result in skipped.items():
+        file_results[i] = result
+        _record_result(results, result)
+    
+    # The template is read once and shared read-only by every registration;
+    # if that fails, each registration reads it and reports the error itself
+    fixed_image = None
+    if pending:
+        try:
+            fixed_image = sitk.ReadImage(template, sitk.sitkFloat32)
+        except RuntimeError:
+            fixed_image = None
+    
+    # Results are classified and reported as each registration finishes
+    # A single worker registers files in order on the calling thread
     if num_processes == 1:
-        print("🚀 OPTIMIZED: Sequential processing (no multiprocessing overhead)")
-        file_results = []
-        for args in process_args:
-            result = register_single_nifti_file(args)
-            file_results.append(result)
+        print("Sequential processing on the calling thread")
+        # Read the next inputs in a background thread while the current one registers
+        prefetched = _prefetch_moving_images(
+            (i, (input_files[i], template, output_dir, atomic_write)) for i in pending)
+        for i, args, moving_image in prefetched:
+            file_results[i] = register_single_nifti_file(args, moving_image, fixed_image)
+            _record_result(results, file_results[i])
     else:
-        print(f"⚠️  Using multiprocessing Pool with {num_processes} processes")
-        print("   (This may cause lock contention - consider processes=1 for GPU work)")
-        with Pool(num_processes) as pool:
-            file_results = pool.map(register_single_nifti_file, process_args)
-    
-    # Analyze results
-    for result in file_results:
-        results['file_results'].append(result)
-        if result['success']:
-            if "already exists" in result['message']:
-                results['skipped'] += 1
-            else:
-                results['successful'] += 1
-                print(f"✅ {result['message']}")
-        else:
-            results['failed'] += 1
-            results['errors'].append(result['message'])
-            print(f"❌ {result['message']}")
+        # Worker threads take GPUs in turn when they start and keep them; files go
+        # to whichever thread is free
+        num_gpus = torch.cuda.device_count()
+        print(f"Using {num_processes} worker threads across {max(num_gpus, 1)} "
+              f"{'GPU' if num_gpus else 'CPU device'}(s)")
+        pin_threads = {}
+        if num_gpus:
+            gpu_slots = queue.Queue()
+            for n in range(num_processes):
+                gpu_slots.put(n % num_gpus)
+            pin_threads = {'initializer': _pin_worker_thread, 'initargs': (gpu_slots,)}
+        with ThreadPoolExecutor(max_workers=num_processes, **pin_threads) as executor:
+            futures = {
+                executor.submit(_register_on_worker, (input_files[i], template, output_dir, atomic_write),
+                                fixed_image): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                file_results[i] = future.result()
+                _record_result(results, file_results[i])
+    
+    # Keep the detailed results in input order
+    results['file_results'] = file_results
     
     # Save metadata
     metadata_file = os.path.join(output_dir, 'registration_metadata.txt')
@@ -335,7 +718,7 @@ def register_nifti_directory(input_dir, template, output_dir,
         f.write(f"Successful registrations: {results['successful']}\n")
         f.write(f"Skipped (already existed): {results['skipped']}\n")
         f.write(f"Failed registrations: {results['failed']}\n")
-        f.write(f"Parallel processes used: {num_processes}\n")
+        f.write(f"Worker threads used: {num_processes}\n")
         
         if results['errors']:
             f.write("\nErrors encountered:\n")
@@ -354,8 +737,10 @@ def register_nifti_directory(input_dir, template, output_dir,
 def register_nifti(input_dir, output_dir, template=None, template_strategy='average', 
                    pattern='*.nii.gz', processes=1):
     """
-    OPTIMIZED: Direct function call interface for NIfTI registration
-    Based on CPU profiling: processes=1 eliminates 99% lock contention for 35x speedup
+    Direct function call interface for NIfTI registration
+    Files are registered by worker threads in this process. Each thread takes
+    one of the available GPUs in turn when it starts and keeps that GPU, its
+    CUDA stream and its models; files go to whichever thread is free.
     
     Args:
         input_dir: Directory containing input NIfTI files
@@ -363,12 +748,13 @@ def register_nifti(input_dir, output_dir, template=None, template_strategy='aver
         template: Template NIfTI file (optional, auto-generates if None)
         template_strategy: Template generation strategy ('average', 'central', 'specified')
         pattern: File pattern to match (default: '*.nii.gz')
-        processes: Number of parallel processes (OPTIMIZED: default=1 for best performance)
+        processes: Number of registration worker threads, spread across GPUs (default: 1;
+            1 reads the next image ahead while the current one registers)
         
     Returns:
         Dict with processing results or None if failed
     """
-    print("=== OPTIMIZED NIfTI Registration Processing ===")
+    print("=== NIfTI Registration Processing ===")
     print(f"Input directory: {input_dir}")
     if template:
         print(f"Template file: {template}")
@@ -377,14 +763,8 @@ def register_nifti(input_dir, output_dir, template=None, template_strategy='aver
     print(f"Output directory: {output_dir}")
     print(f"File pattern: {pattern}")
     
-    # OPTIMIZATION: Show performance benefit of single process
-    if processes == 1:
-        print(f"🚀 OPTIMIZED: Single process mode (eliminates 99% CPU lock contention)")
-    else:
-        print(f"⚠️  WARNING: {processes} processes may cause lock contention (356s+ overhead)")
-        print(f"   Recommendation: Use processes=1 for 35x speedup")
-    
-    print(f"Parallel processes: {processes}")
+    num_gpus = torch.cuda.device_count()
+    print(f"Worker threads: {processes} across {max(num_gpus, 1)} {'GPU' if num_gpus else 'CPU device'}(s)")
     
     # Verify template exists (if specified)
     if template and not os.path.exists(template):
@@ -410,7 +790,7 @@ def register_nifti(input_dir, output_dir, template=None, template_strategy='aver
         print("❌ Registration processing failed")
         return None
     
-    # Print summary with performance notes
+    # Print summary
     print(f"\n{'='*60}")
     print("REGISTRATION PROCESSING SUMMARY")
     print('='*60)
@@ -419,11 +799,6 @@ def register_nifti(input_dir, output_dir, template=None, template_strategy='aver
     print(f"❌ Failed: {results['failed']}")
     print(f"📊 Total: {results['total_files']}")
     
-    if processes == 1:
-        print(f"🚀 PERFORMANCE: Optimized single-process mode used!")
-    else:
-        print(f"⚠️  PERFORMANCE: Consider using processes=1 for optimal speed")
-    
     return results
 
 def main():
@@ -438,7 +813,7 @@ def main():
     parser.add_argument('--pattern', default='*.nii.gz', 
                        help='File pattern to match (default: *.nii.gz)')
     parser.add_argument('--processes', type=int, default=4,
-                       help='Number of parallel processes (default: 4)')
+                       help='Number of registration worker threads, assigned to GPUs in turn (default: 4)')
     
     args = parser.parse_args()
     
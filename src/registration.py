@@ -2,11 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import atexit
 import os
+import shutil
+import tempfile
+import threading
 from os.path import join
+import numpy as np
 import SimpleITK as sitk
+import torch
 from aligner import Aligner
-from monai.transforms import LoadImage, EnsureChannelFirst
 from warper import Warper
 from composedeformations import composedeformation
 from applydeformation import applydeformation
@@ -25,19 +30,16 @@ def create_center_aligned_transform(fixed_image, moving_image):
     Returns:
         SimpleITK Euler3DTransform with center-to-center translation
     """
-    # Get physical centers of both images
-    fixed_center = [
-        fixed_image.GetOrigin()[i] + fixed_image.GetSpacing()[i] * fixed_image.GetSize()[i] / 2.0
-        for i in range(3)
-    ]
-    
-    moving_center = [
-        moving_image.GetOrigin()[i] + moving_image.GetSpacing()[i] * moving_image.GetSize()[i] / 2.0
-        for i in range(3)
-    ]
+    # Get physical centers of both images: origin + spacing * size / 2
+    fixed_center = (np.array(fixed_image.GetOrigin())
+                    + np.array(fixed_image.GetSpacing()) * np.array(fixed_image.GetSize()) / 2.0)
+    moving_center = (np.array(moving_image.GetOrigin())
+                     + np.array(moving_image.GetSpacing()) * np.array(moving_image.GetSize()) / 2.0)
     
     # Calculate translation needed to align centers
-    translation = [fixed_center[i] - moving_center[i] for i in range(3)]
+    translation = (fixed_center - moving_center).tolist()
+    fixed_center = fixed_center.tolist()
+    moving_center = moving_center.tolist()
     
     # Create Euler3D transform with center alignment
     transform = sitk.Euler3DTransform()
@@ -50,9 +52,32 @@ def create_center_aligned_transform(fixed_image, moving_image):
     return transform
 
 
-def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinloss='cc', le=1500, ne=5000, device='cuda'):
+# Intermediate images are written to RAM-backed storage when it is available
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+_thread_scratch = threading.local()
+
+
+def _worker_scratch_dir():
+    """
+    Return this thread's scratch directory under SCRATCH_DIR, creating it on
+    first use. It is reused for every registration the thread runs and
+    removed when the interpreter exits.
+    """
+    if not hasattr(_thread_scratch, 'path'):
+        _thread_scratch.path = tempfile.mkdtemp(prefix="rodreg_", dir=SCRATCH_DIR)
+        atexit.register(shutil.rmtree, _thread_scratch.path, ignore_errors=True)
+    return _thread_scratch.path
+
+
+def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinloss='cc', le=1500, ne=5000, device='cuda',
+                                   moving_image=None, fixed_image=None, aligner=None, nonlin_reg=None):
     """
     Perform nonlinear registration between two medical images
+    The composed deformation field and its inverse are kept in a directory
+    next to the moving image. Intermediate images and fields only live for
+    the call; they are written uncompressed to the thread's scratch
+    directory under SCRATCH_DIR.
     
     Args:
         moving (str): Path to moving image
@@ -63,10 +88,15 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
         le (int): Linear epochs (default: 1500)
         ne (int): Nonlinear epochs (default: 5000)
         device (str): Computing device (default: 'cuda')
+        moving_image: Optional SimpleITK image of moving, already read as float32
+        fixed_image: Optional SimpleITK image of fixed, already read as float32
+        aligner: Optional Aligner to reuse across calls (one per thread)
+        nonlin_reg: Optional Warper to reuse across calls (one per thread)
     
     Returns:
         bool: True if registration successful, False otherwise
     """
+    scratch_files = []
     try:
         if not os.path.exists(fixed):
             print('ERROR: file', fixed, 'does not exist.')
@@ -78,27 +108,31 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
 
         subID = moving.split('.')[0]
         # Add process ID to avoid race conditions in parallel processing
-        import threading
         thread_id = threading.get_ident()
         subbase = f"{subID}.rodreg.{thread_id}"
 
         subbase_dir = subbase + "_dir"
         os.makedirs(subbase_dir, exist_ok=True)
 
-        centered_moving = join(subbase_dir, "moving.cent.nii.gz")
-        centered_moving_linreg = join(subbase_dir, "moving.lin.nii.gz")
-        lin_reg_map_file = join(subbase_dir, "lin_ddf.map.nii.gz")
+        scratch_dir = _worker_scratch_dir()
+        centered_moving = join(scratch_dir, "moving.cent.nii")
+        centered_moving_linreg = join(scratch_dir, "moving.lin.nii")
+        lin_reg_map_file = join(scratch_dir, "lin_ddf.map.nii")
 
         # Temporary file for nonlinear output (not used in final result)
-        centered_moving_nonlinreg = join(subbase_dir, "moving.nonlin.temp.nii.gz")
-        nonlin_reg_map_file = join(subbase_dir, "nonlin_ddf.map.nii.gz")
-        inv_nonlin_reg_map_file = join(subbase_dir, "inv.nonlin_ddf.map.nii.gz")
+        centered_moving_nonlinreg = join(scratch_dir, "moving.nonlin.temp.nii")
+        nonlin_reg_map_file = join(scratch_dir, "nonlin_ddf.map.nii")
+        inv_nonlin_reg_map_file = join(scratch_dir, "inv.nonlin_ddf.map.nii")
+        scratch_files = [centered_moving, centered_moving_linreg, lin_reg_map_file,
+                         centered_moving_nonlinreg, nonlin_reg_map_file, inv_nonlin_reg_map_file]
 
         composed_ddf_file = join(subbase_dir, "composed_ddf.map.nii.gz")
         inv_composed_ddf_file = join(subbase_dir, "inv.composed_ddf.map.nii.gz")
 
-        fixed_image = sitk.ReadImage(fixed, sitk.sitkFloat32)
-        moving_image = sitk.ReadImage(moving, sitk.sitkFloat32)
+        if fixed_image is None:
+            fixed_image = sitk.ReadImage(fixed, sitk.sitkFloat32)
+        if moving_image is None:
+            moving_image = sitk.ReadImage(moving, sitk.sitkFloat32)
         
         # Create center-to-center alignment transform for better initialization
         initial_transform = create_center_aligned_transform(fixed_image, moving_image)
@@ -114,7 +148,8 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
 
         sitk.WriteImage(moved_image, centered_moving)
 
-        aligner = Aligner()
+        if aligner is None:
+            aligner = Aligner()
         aligner.affine_reg(
             fixed_file=fixed,
             moving_file=centered_moving,
@@ -125,10 +160,8 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
             max_epochs=le
         )
 
-        disp_field, _ = LoadImage(image_only=False)(lin_reg_map_file)
-        disp_field = EnsureChannelFirst()(disp_field)
-
-        nonlin_reg = Warper()
+        if nonlin_reg is None:
+            nonlin_reg = Warper()
         nonlin_reg.nonlinear_reg(
             target_file=fixed,
             moving_file=centered_moving_linreg,
@@ -143,13 +176,15 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
             device=device,
         )
 
-        composedeformation(nonlin_reg_map_file, lin_reg_map_file, composed_ddf_file)
+        # Compose and invert on the registration device (the aligner falls back to CPU the same way)
+        field_device = "cpu" if device == "cuda" and not torch.cuda.is_available() else device
+        composedeformation(nonlin_reg_map_file, lin_reg_map_file, composed_ddf_file, device=field_device)
 
         # Apply the composed deformation field to the moving image
         applydeformation(centered_moving, composed_ddf_file, output)
 
         # Invert the composed deformation field this takes about 5-7 min
-        invertdeformationfield(composed_ddf_file, inv_composed_ddf_file)
+        invertdeformationfield(composed_ddf_file, inv_composed_ddf_file, device=field_device)
         
         print(f"✅ Registration completed successfully: {output}")
         return True
@@ -158,6 +193,14 @@ def perform_nonlinear_registration(moving, fixed, output, linloss='cc', nonlinlo
         print(f"❌ Registration failed with error: {str(e)}")
         return False
 
+    finally:
+        # Free the scratch space now; the directory itself is reused
+        for scratch_file in scratch_files:
+            try:
+                os.unlink(scratch_file)
+            except OSError:
+                pass
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Runs rodreg full registration module workflow')
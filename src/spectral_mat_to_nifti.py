@@ -1,13 +1,154 @@
 # Read spectral .mat file and save as .nii.gz files with correct spectral dimension handling
 
 import os
+import gzip
+import shutil
 import numpy as np
 import scipy.io as sio
-import nibabel as nib
-from nilearn import plotting
 import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+from utils import SPECTRAL_4D_FILENAME, available_memory_bytes, is_hdf5_mat
 
-def convert_spectral_mat_to_nifti(mat_file, output_dir, res=None):
+
+def split_spectral_volumes(img_data, max_workers=None):
+    """
+    Copy (z, y, x, spectral) data into contiguous (spectral, z, y, x) volumes
+    
+    Each spectral point is copied by its own thread; NumPy releases the GIL
+    during the strided copy so the work spreads across memory channels.
+    
+    Args:
+        img_data (np.ndarray): 4D spectral data with the spectral dimension last
+        max_workers (int): Optional thread count (default: ThreadPoolExecutor default)
+    
+    Returns:
+        np.ndarray: C-contiguous array of shape (spectral, z, y, x)
+    """
+    if img_data.ndim != 4:
+        raise ValueError(f"Expected 4D spectral data, got shape {img_data.shape}")
+    
+    volumes = np.empty((img_data.shape[-1],) + img_data.shape[:-1], dtype=img_data.dtype)
+    
+    def copy_volume(spectral_idx):
+        volumes[spectral_idx] = img_data[..., spectral_idx]
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(copy_volume, range(img_data.shape[-1])))
+    
+    return volumes
+
+def _write_nifti_gz(img_sitk, filename, compresslevel=1):
+    """
+    Write a SimpleITK image to a .nii.gz path, gzipped at compresslevel
+    
+    The image is written uncompressed and then gzipped, since SimpleITK's
+    NIfTI writer ignores the compression level and its default dominates the
+    write time. SimpleITK and zlib both release the GIL, so several files can
+    be written at once from a thread pool.
+    """
+    raw_filename = filename[:-len(".gz")]
+    sitk.WriteImage(img_sitk, raw_filename)
+    try:
+        with open(raw_filename, 'rb') as src, gzip.open(filename, 'wb', compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    finally:
+        os.unlink(raw_filename)
+
+def _write_spectral_point(spectral_idx, spatial_volume, spacing, output_dir, compresslevel=1):
+    """
+    Write one contiguous (z, y, x) spectral volume as spectral_point_NNN.nii.gz
+    
+    Returns:
+        str: Path of the written file
+    """
+    # SimpleITK expects (z, y, x) ordering, and our data is already in (z, y, x)
+    img_sitk = sitk.GetImageFromArray(spatial_volume)
+    
+    # Set spacing using the resolution from the mat file
+    img_sitk.SetSpacing(spacing)
+    
+    # Generate filename for this spectral point
+    filename = os.path.join(output_dir, f"spectral_point_{spectral_idx:03d}.nii.gz")
+    _write_nifti_gz(img_sitk, filename, compresslevel)
+    return filename
+
+def _write_spectral_4d(spectral_volumes, spacing, output_dir, compresslevel=1):
+    """
+    Write contiguous (spectral, z, y, x) volumes as a single 4D NIfTI file
+    
+    The image is (x, y, z, spectral) on disk with unit spacing along the
+    spectral axis.
+    
+    Returns:
+        str: Path of the written file
+    """
+    img_sitk = sitk.GetImageFromArray(spectral_volumes, isVector=False)
+    img_sitk.SetSpacing(list(spacing) + [1.0])
+    filename = os.path.join(output_dir, SPECTRAL_4D_FILENAME)
+    _write_nifti_gz(img_sitk, filename, compresslevel)
+    return filename
+
+def _hdf5_spectral_ranges(dataset, budget_bytes):
+    """
+    Split the spectral (last) axis of a 4D HDF5 dataset into (start, stop) ranges
+    
+    One read of a range decompresses each chunk it touches once, so the ranges
+    are as large as budget_bytes allows (a range costs its hyperslab plus the
+    split copy) and end on chunk boundaries, so no chunk is shared by two
+    ranges. A dataset that fits the budget is read in a single range.
+    """
+    num_points = dataset.shape[-1]
+    volume_bytes = max(int(np.prod(dataset.shape[:-1])) * dataset.dtype.itemsize, 1)
+    points_per_range = max(1, min(num_points, budget_bytes // (2 * volume_bytes)))
+    chunk_points = dataset.chunks[-1] if dataset.chunks else 1
+    if chunk_points <= points_per_range < num_points:
+        points_per_range -= points_per_range % chunk_points
+    return [(start, min(start + points_per_range, num_points))
+            for start in range(0, num_points, points_per_range)]
+
+def _read_hdf5_spectral_groups(dataset, budget_bytes=None):
+    """
+    Yield (start, volumes) for consecutive spectral ranges of a 4D HDF5 dataset
+    
+    Each range is one read_direct call into a (z, y, x, n) buffer, split into
+    contiguous (n, z, y, x) volumes in memory. By default the ranges are sized
+    to half the available memory.
+    """
+    if budget_bytes is None:
+        budget_bytes = available_memory_bytes() // 2
+    for start, stop in _hdf5_spectral_ranges(dataset, budget_bytes):
+        hyperslab = np.empty(dataset.shape[:-1] + (stop - start,), dtype=dataset.dtype)
+        dataset.read_direct(hyperslab, np.s_[:, :, :, start:stop])
+        yield start, split_spectral_volumes(hyperslab)
+
+def _select_mat_variables(mat_file):
+    """
+    Pick the variables of a v4/v5 .mat file that the conversion reads
+    
+    Only the variable headers are read (scipy.io.whosmat). The spectral data
+    is chosen the same way convert_spectral_mat_to_nifti does after loading:
+    'data', 'Data' or 'img', else the only variable, else the largest one.
+    
+    Returns:
+        list: Variable names to pass to loadmat, or None to load everything
+    """
+    try:
+        variables = sio.whosmat(mat_file)
+    except Exception:
+        return None
+    shapes = {name: shape for name, shape, _ in variables}
+    if not shapes:
+        return None
+    
+    for data_key in ('data', 'Data', 'img'):
+        if data_key in shapes:
+            break
+    else:
+        data_key = max(shapes, key=lambda k: int(np.prod(shapes[k])))
+    
+    return [data_key] + [k for k in ('resolution',) if k in shapes and k != data_key]
+
+def convert_spectral_mat_to_nifti(mat_file, output_dir, res=None, png=True, split=True):
     """
     Convert spectral .mat files to individual NIfTI files with robust format handling
     
@@ -15,6 +156,9 @@ def convert_spectral_mat_to_nifti(mat_file, output_dir, res=None):
         mat_file (str): Path to input .mat file
         output_dir (str): Output directory for NIfTI files
         res (list): Optional resolution override [x, y, z]
+        png (bool): Render PNG previews of the first 5 spectral points (default: True)
+        split (bool): Write one spectral_point_NNN.nii.gz per spectral point
+            (default: True); otherwise write a single 4D spectral_4d.nii.gz
     
     Returns:
         int: Number of spectral points processed
@@ -26,175 +170,218 @@ def convert_spectral_mat_to_nifti(mat_file, output_dir, res=None):
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
     
-    # Robust .mat file loading
-    print("Processing spectral format file...")
-    mat = None
-    
-    # Try multiple loading methods for different .mat formats
+    # The HDF5 file stays open for the lazy reads in the write loop and is
+    # closed on every path out of loading and writing
+    h5file = None
     try:
-        # Method 1: Standard scipy.io.loadmat
-        mat = sio.loadmat(mat_file)
-        print("✅ Loaded with standard method")
-    except Exception as e1:
-        print(f"Standard loading failed: {e1}")
-        try:
-            # Method 2: matlab_compatible mode
-            mat = sio.loadmat(mat_file, matlab_compatible=True)
-            print("✅ Loaded with matlab_compatible=True")
-        except Exception as e2:
-            print(f"MATLAB compatible loading failed: {e2}")
+        # Robust .mat file loading
+        print("Processing spectral format file...")
+        mat = None
+    
+        # Probe the format once from the file signature: MATLAB v7.3 files are HDF5
+        # and go straight to h5py, while v4/v5 files never need it
+        if is_hdf5_mat(mat_file):
             try:
-                # Method 3: squeeze_me=False for different structures
-                mat = sio.loadmat(mat_file, squeeze_me=False, struct_as_record=False)
-                print("✅ Loaded with squeeze_me=False")
-            except Exception as e3:
-                print(f"Alternative loading failed: {e3}")
+                import h5py
+                print("Loading HDF5 format (MATLAB v7.3)...")
+                mat = {}
+                # Keep the file open so 4D datasets stay lazy: the write loop below
+                # reads them in a few large spectral hyperslabs
+                h5file = h5py.File(mat_file, 'r')
+                for key in h5file.keys():
+                    if not key.startswith('#'):
+                        try:
+                            dataset = h5file[key]
+                            if isinstance(dataset, h5py.Dataset) and dataset.ndim == 4:
+                                mat[key] = dataset
+                            elif isinstance(dataset, h5py.Dataset):
+                                # Decompress straight into the final buffer
+                                mat[key] = np.empty(dataset.shape, dtype=dataset.dtype)
+                                dataset.read_direct(mat[key])
+                            else:
+                                mat[key] = np.array(dataset)
+                        except Exception:
+                            try:
+                                mat[key] = h5file[key][()]
+                            except Exception:
+                                print(f"Warning: Could not load key '{key}'")
+                print("✅ Loaded with HDF5 format")
+            except ImportError:
+                print("❌ h5py not available for HDF5 format")
+                raise Exception("All loading methods failed - file format not supported")
+            except Exception as e4:
+                print(f"HDF5 loading failed: {e4}")
+                raise Exception("All loading methods failed - file format not supported")
+        else:
+            # Only deserialize the spectral data and resolution, not every variable
+            variable_names = _select_mat_variables(mat_file)
+        
+            # Try multiple loadmat options for different MAT v4/v5 structures
+            try:
+                # Method 1: Standard scipy.io.loadmat
+                mat = sio.loadmat(mat_file, variable_names=variable_names)
+                print("✅ Loaded with standard method")
+            except Exception as e1:
+                print(f"Standard loading failed: {e1}")
                 try:
-                    # Method 4: Try HDF5 format (MATLAB v7.3)
-                    import h5py
-                    print("Trying HDF5 format (MATLAB v7.3)...")
-                    mat = {}
-                    with h5py.File(mat_file, 'r') as f:
-                        for key in f.keys():
-                            if not key.startswith('#'):
-                                try:
-                                    mat[key] = np.array(f[key])
-                                except Exception:
-                                    try:
-                                        mat[key] = f[key][()]
-                                    except Exception:
-                                        print(f"Warning: Could not load key '{key}'")
-                    print("✅ Loaded with HDF5 format")
-                except ImportError:
-                    print("❌ h5py not available for HDF5 format")
-                    raise Exception("All loading methods failed - file format not supported")
-                except Exception as e4:
-                    print(f"HDF5 loading failed: {e4}")
-                    raise Exception("All loading methods failed - file format not supported")
-    
-    if mat is None:
-        raise Exception("Could not load .mat file with any method")
-    
-    # Extract data with flexible key handling
-    img_data = None
-    data_keys = [k for k in mat.keys() if not k.startswith('__')]
-    print(f"Available keys in .mat file: {data_keys}")
-    
-    # Try to find the spectral data
-    if 'data' in mat:
-        img_data = mat['data']
-    elif 'Data' in mat:
-        img_data = mat['Data']
-    elif 'img' in mat:
-        img_data = mat['img']
-    elif len(data_keys) == 1:
-        # If only one data key, assume it's the spectral data
-        img_data = mat[data_keys[0]]
-        print(f"Using single data key: {data_keys[0]}")
-    else:
-        # Look for the largest array (likely the spectral data)
-        largest_key = None
-        largest_size = 0
-        for key in data_keys:
-            if hasattr(mat[key], 'size') and mat[key].size > largest_size:
-                largest_size = mat[key].size
-                largest_key = key
-        if largest_key:
-            img_data = mat[largest_key]
-            print(f"Using largest array key: {largest_key}")
-    
-    if img_data is None:
-        raise Exception(f"Could not find spectral data in .mat file. Available keys: {data_keys}")
-    
-    # Ensure data is numpy array
-    img_data = np.array(img_data)
-    
-    # Handle different data arrangements
-    if len(img_data.shape) == 3:
-        # Add spectral dimension if missing (as last dimension)
-        img_data = img_data[..., np.newaxis]
-        print("⚠️  Added spectral dimension to 3D data")
-    elif len(img_data.shape) != 4:
-        print(f"⚠️  Unexpected data shape: {img_data.shape}")
-        if img_data.size == 0:
-            raise Exception("Data array is empty")
+                    # Method 2: matlab_compatible mode
+                    mat = sio.loadmat(mat_file, matlab_compatible=True, variable_names=variable_names)
+                    print("✅ Loaded with matlab_compatible=True")
+                except Exception as e2:
+                    print(f"MATLAB compatible loading failed: {e2}")
+                    try:
+                        # Method 3: squeeze_me=False for different structures
+                        mat = sio.loadmat(mat_file, squeeze_me=False, struct_as_record=False,
+                                          variable_names=variable_names)
+                        print("✅ Loaded with squeeze_me=False")
+                    except Exception as e3:
+                        print(f"Alternative loading failed: {e3}")
+                        raise Exception("All loading methods failed - file format not supported")
+    
+        if mat is None:
+            raise Exception("Could not load .mat file with any method")
+    
+        # Extract data with flexible key handling
+        img_data = None
+        data_keys = [k for k in mat.keys() if not k.startswith('__')]
+        print(f"Available keys in .mat file: {data_keys}")
+    
+        # Try to find the spectral data
+        if 'data' in mat:
+            img_data = mat['data']
+        elif 'Data' in mat:
+            img_data = mat['Data']
+        elif 'img' in mat:
+            img_data = mat['img']
+        elif len(data_keys) == 1:
+            # If only one data key, assume it's the spectral data
+            img_data = mat[data_keys[0]]
+            print(f"Using single data key: {data_keys[0]}")
+        else:
+            # Look for the largest array (likely the spectral data)
+            largest_key = max(data_keys, key=lambda k: getattr(mat[k], 'size', 0), default=None)
+            if largest_key and getattr(mat[largest_key], 'size', 0) > 0:
+                img_data = mat[largest_key]
+                print(f"Using largest array key: {largest_key}")
+    
+        if img_data is None:
+            raise Exception(f"Could not find spectral data in .mat file. Available keys: {data_keys}")
+    
+        # Ensure data is numpy array; a lazy 4D HDF5 dataset is left on disk
+        if not (h5file is not None and img_data.ndim == 4):
+            img_data = np.array(img_data)
+    
+        # Handle different data arrangements
+        if len(img_data.shape) == 3:
+            # Add spectral dimension if missing (as last dimension)
+            img_data = img_data[..., np.newaxis]
+            print("⚠️  Added spectral dimension to 3D data")
+        elif len(img_data.shape) != 4:
+            print(f"⚠️  Unexpected data shape: {img_data.shape}")
+            if img_data.size == 0:
+                raise Exception("Data array is empty")
 
-    # Shape should be (z, y, x, spectral) - spectral dimension is LAST
-    print(f"Final data shape: {img_data.shape}")    # Read resolution from mat file, with fallback to parameter or default
-    if res is not None:
-        resolution = res
-        print(f"Using provided resolution override: {resolution}")
-    elif 'resolution' in mat:
-        resolution = mat['resolution']#[0]
-        print(f"Using resolution from mat file: {resolution}")
-    else:
-        resolution = [1, 1, 1]
-        print(f"Using default resolution: {resolution}")
+        # Shape should be (z, y, x, spectral) - spectral dimension is LAST
+        print(f"Final data shape: {img_data.shape}")    # Read resolution from mat file, with fallback to parameter or default
+        if res is not None:
+            resolution = res
+            print(f"Using provided resolution override: {resolution}")
+        elif 'resolution' in mat:
+            resolution = mat['resolution']#[0]
+            print(f"Using resolution from mat file: {resolution}")
+        else:
+            resolution = [1, 1, 1]
+            print(f"Using default resolution: {resolution}")
     
-    # Convert to appropriate spacing format
-    if len(resolution) >= 3:
-        spacing = [float(resolution[0]), float(resolution[1]), float(resolution[2])]
-    else:
-        spacing = [2.3, 2.3, 5.0]  # fallback default
-        print(f"Warning: Invalid resolution format, using default spacing: {spacing}")
-    
-    print(f"Original data shape: {img_data.shape}")
-    print(f"Spectral points: {img_data.shape[-1]}")
-    print(f"Spatial dimensions: {img_data.shape[:-1]}")
-    print(f"Resolution from file: {resolution}")
-    print(f"Spacing used: {spacing}")
+        # Convert to appropriate spacing format
+        if len(resolution) >= 3:
+            spacing = [float(resolution[0]), float(resolution[1]), float(resolution[2])]
+        else:
+            spacing = [2.3, 2.3, 5.0]  # fallback default
+            print(f"Warning: Invalid resolution format, using default spacing: {spacing}")
+    
+        print(f"Original data shape: {img_data.shape}")
+        print(f"Spectral points: {img_data.shape[-1]}")
+        print(f"Spatial dimensions: {img_data.shape[:-1]}")
+        print(f"Resolution from file: {resolution}")
+        print(f"Spacing used: {spacing}")
 
-    # The data organization is:
-    # Original: (z, y, x, spectral) = (12, 52, 104, 31)
-    # For NIfTI: we want (z, y, x) for each spectral point
+        # The data organization is:
+        # Original: (z, y, x, spectral) = (12, 52, 104, 31)
+        # For NIfTI: we want (z, y, x) for each spectral point
 
-    # Create one NIfTI file for each spectral point
-    num_spectral_points = img_data.shape[-1]  # Last dimension is spectral
+        # Create one NIfTI file for each spectral point
+        num_spectral_points = img_data.shape[-1]  # Last dimension is spectral
+        if isinstance(img_data, np.ndarray):
+            spectral_groups = [(0, split_spectral_volumes(img_data))]
+        else:
+            # Read the lazy HDF5 dataset in a few large hyperslabs rather than one
+            # strided read per spectral point, each of which would decompress
+            # every chunk of the file
+            spectral_groups = _read_hdf5_spectral_groups(img_data)
 
-    for spectral_idx in range(num_spectral_points):
-        # Extract the spatial volume for this spectral point
-        # Shape will be (12, 52, 104) = (z, y, x)
-        spatial_volume = img_data[:, :, :, spectral_idx]        # Convert to SimpleITK format
-        # SimpleITK expects (z, y, x) ordering, and our data is already in (z, y, x)
-        # Current: (z=12, y=52, x=104) -> Already correct for SimpleITK
-        spatial_volume_sitk = spatial_volume  # Already (z, y, x)
-        
-        img_sitk = sitk.GetImageFromArray(spatial_volume_sitk)
-        
-        # Set spacing using the resolution from the mat file
-        img_sitk.SetSpacing(spacing)
-        
-        # Generate filename for this spectral point
-        filename = f"{output_dir}/spectral_point_{spectral_idx:03d}.nii.gz"
-        sitk.WriteImage(img_sitk, filename)
-        print(f"Saved spectral point {spectral_idx}: {filename}")
+        if split:
+            # Each spectral point is written by its own thread; shape (z, y, x), already contiguous
+            with ThreadPoolExecutor() as executor:
+                for start, volumes in spectral_groups:
+                    filenames = executor.map(
+                        lambda offset: _write_spectral_point(start + offset, volumes[offset],
+                                                             spacing, output_dir),
+                        range(len(volumes)))
+                    for offset, filename in enumerate(filenames):
+                        print(f"Saved spectral point {start + offset}: {filename}")
+        else:
+            spectral_volumes = None
+            for start, volumes in spectral_groups:
+                if start == 0 and len(volumes) == num_spectral_points:
+                    spectral_volumes = volumes
+                    break
+                if spectral_volumes is None:
+                    spectral_volumes = np.empty((num_spectral_points,) + volumes.shape[1:], dtype=volumes.dtype)
+                spectral_volumes[start:start + len(volumes)] = volumes
+            filename = _write_spectral_4d(spectral_volumes, spacing, output_dir)
+            print(f"Saved {num_spectral_points} spectral points: {filename}")
+    finally:
+        if h5file is not None:
+            h5file.close()
     
     # Also create PNG visualizations for the first few spectral points
-    print("\nCreating PNG visualizations for first 5 spectral points...")
-    for spectral_idx in range(min(5, num_spectral_points)):
-        nii_file = f"{output_dir}/spectral_point_{spectral_idx:03d}.nii.gz"
-        png_file = f"{output_dir}/spectral_point_{spectral_idx:03d}.png"
-        
-        try:
-            nii_img = nib.load(nii_file)
-            cut_coords = [coord / 2 for coord in nii_img.shape[:3]]
-            cut_coords = np.array(cut_coords) * np.array(nii_img.affine.diagonal()[:3])
-            plotting.plot_anat(nii_file, display_mode='ortho', 
-                             cut_coords=cut_coords, output_file=png_file,
-                             title=f"Spectral Point {spectral_idx}")
-            print(f"Saved visualization: {png_file}")
-        except Exception as e:
-            print(f"Warning: Could not create visualization for spectral point {spectral_idx}: {e}")
+    if png:
+        # nilearn pulls in matplotlib, so it is only imported when previews are made
+        from nilearn import image, plotting
+        print("\nCreating PNG visualizations for first 5 spectral points...")
+        # Volume centre in world coordinates, from the shape and spacing already in
+        # memory: the files are (x, y, z) with the LPS -> RAS sign flip SimpleITK
+        # applies on write, and a float32 pixdim
+        cut_coords = (np.array(img_data.shape[2::-1]) / 2 * np.array([-1, -1, 1])
+                      * np.asarray(spacing, dtype=np.float32))
+        prefix = os.path.join(output_dir, "spectral_point_")
+        if not split:
+            img_4d = image.load_img(os.path.join(output_dir, SPECTRAL_4D_FILENAME))
+        for spectral_idx in range(min(5, num_spectral_points)):
+            if split:
+                nii_file = prefix + f"{spectral_idx:03d}.nii.gz"
+            else:
+                nii_file = image.index_img(img_4d, spectral_idx)
+            png_file = prefix + f"{spectral_idx:03d}.png"
+            
+            try:
+                plotting.plot_anat(nii_file, display_mode='ortho', 
+                                 cut_coords=cut_coords, output_file=png_file,
+                                 title=f"Spectral Point {spectral_idx}")
+                print(f"Saved visualization: {png_file}")
+            except Exception as e:
+                print(f"Warning: Could not create visualization for spectral point {spectral_idx}: {e}")
     
     # Save metadata
-    metadata_file = f"{output_dir}/spectral_metadata.txt"
+    metadata_file = os.path.join(output_dir, "spectral_metadata.txt")
     with open(metadata_file, 'w') as f:
         f.write("Data from spectral format .mat file\n")
         f.write(f"Original data shape: {img_data.shape}\n")
         f.write(f"Spectral dimension: {img_data.shape[-1]} (last dimension)\n")
         f.write(f"Spatial dimensions: {img_data.shape[:-1]} (z, y, x)\n")
         f.write(f"Resolution: {resolution}\n")
-        f.write(f"Number of NIfTI files created: {num_spectral_points}\n")
+        f.write(f"Number of NIfTI files created: {num_spectral_points if split else 1}\n")
         f.write(f"Spacing used: {spacing}\n")
     
     print(f"Saved metadata: {metadata_file}")
@@ -218,6 +405,8 @@ if __name__ == "__main__":
         print("Arguments:")
         print("  input_mat_file     Path to input .mat file containing spectral data")
         print("  output_directory   Directory to save the converted NIfTI files")
+        print("  --no-split         Write a single 4D NIfTI file instead of one per point")
+        print("  --no-png           Skip the PNG visualizations")
         print()
         print("The script will:")
         print("  1. Read spectral data from .mat file")
@@ -233,6 +422,11 @@ if __name__ == "__main__":
     parser.add_argument('output_dir', help='Output directory for NIfTI files')
     parser.add_argument('--res', nargs=3, type=float, metavar=('X', 'Y', 'Z'),
                        help='Override resolution [x y z] in mm (default: read from .mat file)')
+    parser.add_argument('--no-split', dest='split', action='store_false',
+                       help=f'Write all spectral points to a single 4D {SPECTRAL_4D_FILENAME} '
+                            'instead of one file per point')
+    parser.add_argument('--no-png', action='store_true',
+                       help='Skip the PNG visualizations of the first 5 spectral points')
     
     # Check if no arguments provided
     import sys
@@ -253,13 +447,18 @@ if __name__ == "__main__":
         res = None
     
     # Process the data
-    num_spectral = convert_spectral_mat_to_nifti(args.mat_file, args.output_dir, res)
+    num_spectral = convert_spectral_mat_to_nifti(args.mat_file, args.output_dir, res, png=not args.no_png,
+                                                 split=args.split)
     
     print("\n=== Processing Complete ===")
     if num_spectral and num_spectral > 0:
-        print(f"✅ Created {num_spectral} spectral NIfTI files")
-        print("✅ Files saved with naming: spectral_point_000.nii.gz, spectral_point_001.nii.gz, etc.")
-        print("✅ PNG visualizations created for first 5 spectral points")
+        if args.split:
+            print(f"✅ Created {num_spectral} spectral NIfTI files")
+            print("✅ Files saved with naming: spectral_point_000.nii.gz, spectral_point_001.nii.gz, etc.")
+        else:
+            print(f"✅ Saved {num_spectral} spectral points as one 4D file: {SPECTRAL_4D_FILENAME}")
+        if not args.no_png:
+            print("✅ PNG visualizations created for first 5 spectral points")
         print("✅ Metadata saved to spectral_metadata.txt")
         print("\nTo convert back to .mat format, run:")
         print(f"python spectral_nifti_to_mat.py {args.output_dir} reconstructed.mat {args.mat_file}")
@@ -4,15 +4,23 @@ import os
 import numpy as np
 import scipy.io as sio
 import nibabel as nib
-import SimpleITK as sitk
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from utils import SPECTRAL_4D_FILENAME, find_spectral_point_files, is_hdf5_mat
+
+# NumPy dtypes scipy.io.loadmat returns for each MATLAB numeric class
+MAT_CLASS_DTYPES = {
+    'double': np.float64, 'single': np.float32, 'logical': np.uint8,
+    'int8': np.int8, 'uint8': np.uint8, 'int16': np.int16, 'uint16': np.uint16,
+    'int32': np.int32, 'uint32': np.uint32, 'int64': np.int64, 'uint64': np.uint64,
+}
 
 def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=None):
     """
     Convert spectral NIfTI files back to the original .mat format
     
     Args:
-        nifti_dir (str): Directory containing spectral_point_*.nii.gz files
+        nifti_dir (str): Directory containing spectral_point_*.nii.gz files, or a
+            single 4D spectral_4d.nii.gz
         output_mat_file (str): Output .mat file path
         original_mat_file (str): Optional original .mat file for metadata comparison
     
@@ -25,16 +33,18 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
         print(f"ERROR: Directory {nifti_dir} does not exist.")
         return False
     
-    # Find all spectral point NIfTI files
-    nifti_pattern = os.path.join(nifti_dir, "spectral_point_*.nii.gz")
-    nifti_files = sorted(glob.glob(nifti_pattern))
+    # Find all spectral point NIfTI files, ordered by spectral index
+    nifti_files = find_spectral_point_files(nifti_dir)
+    spectral_4d_file = os.path.join(nifti_dir, SPECTRAL_4D_FILENAME)
     
-    if not nifti_files:
+    if nifti_files:
+        print(f"Found {len(nifti_files)} spectral NIfTI files")
+    elif os.path.exists(spectral_4d_file):
+        print(f"Found 4D spectral NIfTI file {SPECTRAL_4D_FILENAME}")
+    else:
         print(f"ERROR: No spectral_point_*.nii.gz files found in {nifti_dir}")
         return False
     
-    print(f"Found {len(nifti_files)} spectral NIfTI files")
-    
         # Load original file metadata if provided - preserve ALL fields except 'data'
     original_metadata = {}
     original_data_dtype = np.uint16  # Default fallback
@@ -42,48 +52,74 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
         try:
             print(f"Preserving metadata from original file: {original_mat_file}")
             
-            # Try multiple loading methods for different .mat formats
+            # Probe the format once from the file signature: MATLAB v7.3 files
+            # are HDF5 and go straight to h5py
             original_data = None
-            try:
-                # Method 1: Standard loading
-                original_data = sio.loadmat(original_mat_file)
-                print("  ✅ Original file loaded with standard method")
-            except Exception as e1:
-                print(f"  Standard loading failed: {e1}")
+            if is_hdf5_mat(original_mat_file):
+                try:
+                    import h5py
+                    print("  Loading HDF5 format for original file...")
+                    original_data = {}
+                    with h5py.File(original_mat_file, 'r') as f:
+                        for key in f.keys():
+                            if key.startswith('#'):
+                                continue
+                            if key.lower() in ['data', 'img']:
+                                # Only the data type of the image is needed, not its voxels
+                                original_data[key] = np.empty(0, dtype=f[key].dtype)
+                                continue
+                            try:
+                                original_data[key] = np.array(f[key])
+                            except Exception:
+                                try:
+                                    original_data[key] = f[key][()]
+                                except Exception:
+                                    print(f"  Warning: Could not load original key '{key}'")
+                    print("  ✅ Original file loaded with HDF5 format")
+                except ImportError:
+                    print("  ❌ h5py not available for HDF5 format")
+                    original_data = None
+                except Exception as e4:
+                    print(f"  HDF5 loading failed: {e4}")
+                    original_data = None
+            else:
+                # Read the image's data type from the variable headers alone and
+                # load every other variable, so the voxels are never deserialized
+                variable_names = None
+                data_placeholders = {}
+                try:
+                    variables = sio.whosmat(original_mat_file)
+                    for name, _, mat_class in variables:
+                        if name.lower() in ['data', 'img'] and mat_class in MAT_CLASS_DTYPES:
+                            data_placeholders[name] = np.empty(0, dtype=MAT_CLASS_DTYPES[mat_class])
+                    if data_placeholders:
+                        variable_names = [name for name, _, _ in variables if name not in data_placeholders]
+                except Exception as e0:
+                    print(f"  Variable header probe failed: {e0}")
+                
                 try:
-                    # Method 2: matlab_compatible mode
-                    original_data = sio.loadmat(original_mat_file, matlab_compatible=True)
-                    print("  ✅ Original file loaded with matlab_compatible=True")
-                except Exception as e2:
-                    print(f"  MATLAB compatible loading failed: {e2}")
+                    # Method 1: Standard loading
+                    original_data = sio.loadmat(original_mat_file, variable_names=variable_names)
+                    print("  ✅ Original file loaded with standard method")
+                except Exception as e1:
+                    print(f"  Standard loading failed: {e1}")
                     try:
-                        # Method 3: squeeze_me=False
-                        original_data = sio.loadmat(original_mat_file, squeeze_me=False, struct_as_record=False)
-                        print("  ✅ Original file loaded with squeeze_me=False")
-                    except Exception as e3:
-                        print(f"  Alternative loading failed: {e3}")
+                        # Method 2: matlab_compatible mode
+                        original_data = sio.loadmat(original_mat_file, matlab_compatible=True,
+                                                    variable_names=variable_names)
+                        print("  ✅ Original file loaded with matlab_compatible=True")
+                    except Exception as e2:
+                        print(f"  MATLAB compatible loading failed: {e2}")
                         try:
-                            # Method 4: Try HDF5 format
-                            import h5py
-                            print("  Trying HDF5 format for original file...")
-                            original_data = {}
-                            with h5py.File(original_mat_file, 'r') as f:
-                                for key in f.keys():
-                                    if not key.startswith('#'):
-                                        try:
-                                            original_data[key] = np.array(f[key])
-                                        except Exception:
-                                            try:
-                                                original_data[key] = f[key][()]
-                                            except Exception:
-                                                print(f"  Warning: Could not load original key '{key}'")
-                            print("  ✅ Original file loaded with HDF5 format")
-                        except ImportError:
-                            print("  ❌ h5py not available for HDF5 format")
-                            original_data = None
-                        except Exception as e4:
-                            print(f"  HDF5 loading failed: {e4}")
+                            # Method 3: squeeze_me=False
+                            original_data = sio.loadmat(original_mat_file, squeeze_me=False, struct_as_record=False,
+                                                        variable_names=variable_names)
+                            print("  ✅ Original file loaded with squeeze_me=False")
+                        except Exception as e3:
+                            print(f"  Alternative loading failed: {e3}")
                             original_data = None
+                if original_data is not None:
+                    original_data.update(data_placeholders)
             
             if original_data is not None:
                 # Extract data type from original file
@@ -118,36 +154,37 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
             print(f"Warning: Could not load original file metadata: {e}")
             print("Proceeding without original metadata preservation")
     
-    # Read all spectral volumes and reconstruct the 4D array
-    spectral_volumes = []
-    nifti_spacing = None
-    
-    for i, nifti_file in enumerate(nifti_files):
-        print(f"Processing {os.path.basename(nifti_file)}...")
-        
-        # Read using SimpleITK
-        img_sitk = sitk.ReadImage(nifti_file)
-        img_array = sitk.GetArrayFromImage(img_sitk)
+    if not nifti_files:
+        # One read of the whole (x, y, z, spectral) image, moving the spectral
+        # axis first while casting
+        img = nib.load(spectral_4d_file)
+        reconstructed_data = np.empty((img.shape[3],) + img.shape[:3], dtype=original_data_dtype)
+        np.copyto(reconstructed_data, np.moveaxis(np.asanyarray(img.dataobj), 3, 0), casting='unsafe')
+        nifti_spacing = tuple(float(zoom) for zoom in img.header.get_zooms()[:3])
+        print(f"  Individual volume shape: {img.shape[:3]}")
+        print(f"  Spacing from NIfTI file: {nifti_spacing}")
+    else:
+        # Read all spectral volumes straight into the preallocated 4D array.
+        # The first header sets the shape and spacing without touching any
+        # voxels; nibabel returns (x, y, z) voxel order, so no transpose is
+        # needed, and zlib releases the GIL so a thread pool reads the files.
+        img = nib.load(nifti_files[0])
         
-        # SimpleITK gives us (z, y, x) which is already the correct spatial ordering
-        # No need to transpose since original data was (z, y, x, spectral)
-        # img_array shape is already (z, y, x)
+        # Allocate (spectral, x, y, z) for MATLAB compatibility in the original data type
+        reconstructed_data = np.empty((len(nifti_files),) + img.shape, dtype=original_data_dtype)
+        nifti_spacing = tuple(float(zoom) for zoom in img.header.get_zooms()[:3])
+        print(f"  Individual volume shape: {img.shape}")
+        print(f"  Spacing from NIfTI file: {nifti_spacing}")
         
-        spectral_volumes.append(img_array)
+        def read_volume(i):
+            # Cast while copying into the slot
+            np.copyto(reconstructed_data[i], np.asanyarray(nib.load(nifti_files[i]).dataobj),
+                      casting='unsafe')
         
-        if i == 0:
-            # Read spacing from the first NIfTI file
-            nifti_spacing = img_sitk.GetSpacing()
-            print(f"  Individual volume shape: {img_array.shape}")
-            print(f"  Spacing from NIfTI file: {nifti_spacing}")
-    
-    # Stack all spectral volumes to create 4D array
-    # Shape should be (z, y, x, num_spectral) = (12, 52, 104, 31)
-    # Stack along the last axis to put spectral dimension last
-    reconstructed_data = np.stack(spectral_volumes, axis=-1)
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
+            for nifti_file, _ in zip(nifti_files, executor.map(read_volume, range(len(nifti_files)))):
+                print(f"Processing {os.path.basename(nifti_file)}...")
     
-    # Transpose to (x, y, z, spectral) for MATLAB compatibility
-    reconstructed_data = np.transpose(reconstructed_data, (3, 2, 1, 0))
     print(f"Reconstructed data shape: {reconstructed_data.shape}")
     
     # Convert NIfTI spacing to resolution format for mat file
@@ -156,8 +193,8 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
         resolution_array = original_metadata['resolution']
         print(f"Using original resolution: {resolution_array}")
     elif nifti_spacing:
-        # NIfTI spacing is (x, y, z), convert to uint8 array format like original
-        resolution_array = np.array([[nifti_spacing[0], nifti_spacing[1], nifti_spacing[2]]], dtype=np.float64)
+        # NIfTI spacing is (x, y, z); kept as float64 so fractional spacings survive
+        resolution_array = np.asarray(nifti_spacing[:3], dtype=np.float64).reshape(1, 3)
         print(f"Resolution derived from NIfTI spacing: {resolution_array}")
     else:
         resolution_array = np.array([[1, 1, 1]], dtype=np.uint8)
@@ -165,7 +202,7 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
     
     # Create the output dictionary starting with the reconstructed data
     output_dict = {
-        'data': reconstructed_data.astype(original_data_dtype),  # Preserve original data type
+        'data': reconstructed_data,  # Already in the original data type
     }
     
     # Add resolution - prefer from NIfTI spacing, fallback to original
@@ -214,7 +251,7 @@ def convert_spectral_nifti_to_mat(nifti_dir, output_mat_file, original_mat_file=
         except ImportError:
             print("WARNING: hdf5storage not installed; saving as MATLAB v5 .mat instead. "
                   "Install with: pip install hdf5storage")
-            sio.savemat(output_mat_file, output_dict, do_compression=False)
+            sio.savemat(output_mat_file, output_dict, do_compression=True)
             print(f"Successfully saved reconstructed data to: {output_mat_file} (MATLAB v5)")
         print(f"Data type: {reconstructed_data.dtype}")
         print(f"Saved fields: {list(output_dict.keys())}")
@@ -1,29 +1,72 @@
+import os
+import re
 import nibabel as nib
 import numpy as np
-from scipy.interpolate import NearestNDInterpolator
+from scipy.ndimage import distance_transform_edt
 
+SPECTRAL_POINT_RE = re.compile(r'^spectral_point_(\d+).*\.nii\.gz$')
 
-def interpolate_zeros(image_data, mask_data):
-    # Find zero values in the image
-    zero_indices = np.argwhere((image_data == 0) & (mask_data > 0))
+# All spectral points in one 4D image, spectral axis last
+SPECTRAL_4D_FILENAME = 'spectral_4d.nii.gz'
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def find_spectral_point_files(nifti_dir):
+    """
+    List spectral_point_*.nii.gz files in a directory ordered by spectral index.
+
+    Sorting on the parsed index keeps spectral_point_10 after spectral_point_2
+    even when indices are not zero-padded. Suffixed names such as
+    spectral_point_000.reg.nii.gz or spectral_point_000_deformed.nii.gz match too.
+    """
+    entries = []
+    with os.scandir(nifti_dir) as it:
+        for entry in it:
+            match = SPECTRAL_POINT_RE.match(entry.name)
+            if match:
+                entries.append((int(match.group(1)), entry.name, entry.path))
+    entries.sort()
+    return [path for _, _, path in entries]
 
-    non_zero_indices = np.argwhere((image_data != 0) & (mask_data > 0))
-    non_zero_values = image_data[non_zero_indices[:, 0],
-                                 non_zero_indices[:, 1], non_zero_indices[:, 2]]
 
-    # Create a NearestNDInterpolator object with non-zero voxel coordinates and values
-    interpolator = NearestNDInterpolator(non_zero_indices, non_zero_values)
+def is_hdf5_mat(mat_file):
+    """
+    Tell a MATLAB v7.3 (HDF5) .mat file from a v4/v5 one by its signature.
 
-    # Create an array of voxel coordinates for zero indices
-    zero_coords = zero_indices[:, [0, 1, 2]]
+    The HDF5 superblock sits at offset 0 or, after a user block such as the
+    512-byte MATLAB header, at a power of two from 512 on.
+    """
+    with open(mat_file, 'rb') as f:
+        for offset in (0, 512, 1024, 2048):
+            f.seek(offset)
+            if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                return True
+    return False
+
+
+def available_memory_bytes(default=4 * 1024 ** 3):
+    """Return the physical memory currently available, or default where it cannot be queried."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return default
+
+
+def interpolate_zeros(image_data, mask_data):
+    # Zero voxels inside the mask take the value of the nearest non-zero voxel
+    # inside the mask
+    zero_mask = (image_data == 0) & (mask_data > 0)
+    non_zero_mask = (image_data != 0) & (mask_data > 0)
 
-    # Use the interpolator to find the nearest non-zero values for all zero voxels
-    interpolated_values = interpolator(zero_coords)
+    # Index of the nearest non-zero voxel for every voxel, from an exact
+    # Euclidean distance transform (linear time, no k-d tree)
+    nearest_indices = distance_transform_edt(~non_zero_mask, return_distances=False,
+                                             return_indices=True)
 
-    # Create an array of voxel values for zero indices
+    # Fill the zero voxels from their nearest non-zero neighbours
     interpolated_data = image_data.copy()
-    interpolated_data[zero_coords[:, 0], zero_coords[:, 1],
-                      zero_coords[:, 2]] = interpolated_values
+    interpolated_data[zero_mask] = image_data[tuple(index[zero_mask] for index in nearest_indices)]
 
     return interpolated_data
 
@@ -42,11 +85,11 @@ def pad_nifti_image(input_path, output_path, padding_mm=10):
     padding_voxels = np.ceil(np.array(padding_mm) /
                              np.array(voxel_sizes)).astype(int)
 
-    # Pad the image data with zeros
-    padded_data = np.pad(img_data, ((padding_voxels[0], padding_voxels[0]),
-                                    (padding_voxels[1], padding_voxels[1]),
-                                    (padding_voxels[2], padding_voxels[2])),
-                         mode='constant')
+    # Pad the image data with zeros: np.zeros maps zero pages lazily, so only
+    # the copied interior is written
+    padded_data = np.zeros(tuple(np.array(img_data.shape) + 2 * padding_voxels),
+                           dtype=original_dtype)
+    padded_data[tuple(slice(p, p + n) for p, n in zip(padding_voxels, img_data.shape))] = img_data
 
     # Update the affine matrix to reflect the new dimensions
     new_affine = affine.copy()
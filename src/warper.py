@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-from monai.utils import set_determinism
 from monai.networks.nets import GlobalNet, LocalNet, RegUNet, unet
 from monai.config import USE_COMPILED
 from monai.networks.blocks import Warp, DVF2DDF
@@ -27,6 +26,7 @@ from deform_losses import GradEnergyLoss
 from networks import LocalNet2
 import argparse
 import nibabel as nib
+from _seeding import call_generator, deterministic_backends, seeded_build, use_seeded_dropout
 
 
 class dscolors:
@@ -46,7 +46,7 @@ class Warper:
     # max_epochs = 3000
     # lr = .01
     def __init__(self):
-        set_determinism(42)
+        deterministic_backends()
 
     # def setLoss(self, loss):
     # 	self.loss=loss
@@ -143,7 +143,6 @@ class Warper:
 
         regularization = myBendingEnergyLoss()  # GradEnergyLoss()
         #######################
-        set_determinism(42)
         self.loadMoving(moving_file)
         self.loadTarget(target_file)
         self.loadTargetMask(target_mask)
@@ -167,7 +166,9 @@ class Warper:
         target_ds = ScaleIntensityRangePercentiles(
             lower=0.5, upper=99.5, b_min=0.0, b_max=10, clip=True
         )(target_ds)
-        reg = unet.UNet(
+        # Seeded weights and a per-call dropout generator keep concurrent
+        # registrations independent of each other's random draws
+        reg = seeded_build(lambda: unet.UNet(
             spatial_dims=3,  # spatial dims
             in_channels=2,
             out_channels=3,  # output channels (to represent 3D displacement vector field)
@@ -175,7 +176,8 @@ class Warper:
             strides=(1, 2, 2, 4),  # convolutional strides
             dropout=0.2,
             norm="batch",
-        ).to(device)
+        ))
+        reg = use_seeded_dropout(reg, call_generator(device)).to(device)
         if USE_COMPILED:
             warp_layer = Warp(3, padding_mode="zeros").to(device)
         else:
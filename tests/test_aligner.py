@@ -0,0 +1,53 @@
+import os
+import sys
+
+import torch
+
+# Add src directory to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from aligner import Aligner, _update_convergence
+
+
+def _epochs_until_stop(losses, patience=5, min_rel_improvement=1e-3, check_every=1):
+    """Run the Aligner early-stopping rule over a loss sequence; return the stopping epoch or None."""
+    best_loss = torch.tensor(float("inf"))
+    stale_epochs = torch.zeros((), dtype=torch.long)
+    for epoch, loss in enumerate(losses):
+        best_loss, stale_epochs = _update_convergence(torch.tensor(loss), best_loss, stale_epochs,
+                                                      min_rel_improvement)
+        if (epoch + 1) % check_every == 0 and stale_epochs.item() > patience:
+            return epoch
+    return None
+
+
+class TestConvergence:
+
+    def test_negative_plateau_stops(self):
+        """A negative (LNCC-like) loss that plateaus must trigger early stopping."""
+        losses = [-0.30, -0.50, -0.60, -0.65] + [-0.65] * 20
+        assert _epochs_until_stop(losses) == 3 + 6
+
+    def test_negative_slow_worsening_stops(self):
+        """A slightly worsening negative loss must not count as an improvement."""
+        losses = [-0.60] + [-0.60 + 1e-5 * i for i in range(1, 20)]
+        assert _epochs_until_stop(losses) == 6
+
+    def test_negative_steady_improvement_continues(self):
+        """A negative loss improving by more than the margin never stops."""
+        losses = [-0.1 * 1.01 ** i for i in range(50)]
+        assert _epochs_until_stop(losses) is None
+
+    def test_positive_plateau_stops(self):
+        """MSE-style positive losses keep stopping on a plateau."""
+        losses = [1.0, 0.5, 0.4] + [0.4] * 20
+        assert _epochs_until_stop(losses) == 2 + 6
+
+    def test_default_settings_match_aligner(self):
+        """The default cc plateau stops within patience + one check interval."""
+        aligner = Aligner()
+        losses = [-0.5] * (aligner.patience + 2 * aligner.convergence_check_every)
+        stop = _epochs_until_stop(losses, aligner.patience, aligner.min_rel_improvement,
+                                  aligner.convergence_check_every)
+        assert stop is not None
+        assert stop < aligner.patience + aligner.convergence_check_every
@@ -6,13 +6,15 @@ import os
 from pathlib import Path
 import scipy.io as sio
 import nibabel as nib
+import SimpleITK as sitk
 from unittest.mock import patch, MagicMock
 
 # Add src directory to path for imports
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from spectral_mat_to_nifti import convert_spectral_mat_to_nifti
+from spectral_mat_to_nifti import (convert_spectral_mat_to_nifti, _hdf5_spectral_ranges,
+                                   _read_hdf5_spectral_groups)
 from spectral_nifti_to_mat import convert_spectral_nifti_to_mat
 
 @pytest.fixture
@@ -282,5 +284,94 @@ class TestRoundTripConversion:
         # Check that resolution is preserved from original metadata
         # Verify original resolution is preserved exactly
         np.testing.assert_array_equal(original_resolution, reconstructed_data['resolution'].flatten())
+
+    def test_roundtrip_single_4d_file_matches_split_files(self, temp_dir):
+        """Test that the single 4D NIfTI layout round-trips like the per-point files."""
+        original_mat = os.path.join(temp_dir, 'original.mat')
+        sio.savemat(original_mat, {
+            'data': (np.random.rand(6, 7, 5, 4) * 1000).astype(np.uint16),
+            'resolution': np.array([1.5, 1.5, 2.0])
+        })
+        
+        split_dir = os.path.join(temp_dir, 'split')
+        single_dir = os.path.join(temp_dir, 'single')
+        convert_spectral_mat_to_nifti(original_mat, split_dir, png=False)
+        convert_spectral_mat_to_nifti(original_mat, single_dir, png=False, split=False)
+        assert [f for f in os.listdir(single_dir) if f.endswith('.nii.gz')] == ['spectral_4d.nii.gz']
+        
+        split_mat = os.path.join(temp_dir, 'split.mat')
+        single_mat = os.path.join(temp_dir, 'single.mat')
+        assert convert_spectral_nifti_to_mat(split_dir, split_mat, original_mat)
+        assert convert_spectral_nifti_to_mat(single_dir, single_mat, original_mat)
+        
+        split_data = sio.loadmat(split_mat)
+        single_data = sio.loadmat(single_mat)
+        assert single_data['data'].dtype == split_data['data'].dtype
+        np.testing.assert_array_equal(single_data['data'], split_data['data'])
+        np.testing.assert_array_equal(single_data['resolution'], split_data['resolution'])
+
+
+class TestHdf5MatToNifti:
+    """MATLAB v7.3 (HDF5) inputs, written with h5py the way MATLAB lays them out."""
+    
+    @pytest.fixture
+    def v73_mat_file(self, tmp_path):
+        h5py = pytest.importorskip("h5py")
+        data = (np.random.default_rng(0).random((6, 9, 8, 11)) * 1000).astype(np.float32)
+        mat_file = str(tmp_path / 'v73.mat')
+        # A 512-byte MATLAB header as user block, then chunked, gzip'd datasets
+        with h5py.File(mat_file, 'w', userblock_size=512) as f:
+            f.create_dataset('data', data=data, chunks=(3, 9, 8, 4), compression='gzip')
+            f.create_dataset('resolution', data=np.array([2.0, 2.0, 3.0]))
+        with open(mat_file, 'r+b') as f:
+            f.write(b'MATLAB 7.3 MAT-file, Platform: GLNXA64'.ljust(128, b' '))
+        return mat_file, data
+    
+    @pytest.mark.parametrize("split", [True, False])
+    def test_volumes_match_dataset(self, v73_mat_file, tmp_path, split):
+        mat_file, data = v73_mat_file
+        output_dir = str(tmp_path / 'nifti')
+        assert convert_spectral_mat_to_nifti(mat_file, output_dir, png=False, split=split) == data.shape[-1]
+        if split:
+            volumes = [sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(output_dir, f"spectral_point_{k:03d}.nii.gz")))
+                       for k in range(data.shape[-1])]
+        else:
+            volumes = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(output_dir, 'spectral_4d.nii.gz')))
+        np.testing.assert_array_equal(np.stack(volumes, axis=-1), data)
+        spacing = sitk.ReadImage(os.path.join(output_dir, "spectral_point_000.nii.gz" if split
+                                              else 'spectral_4d.nii.gz')).GetSpacing()
+        assert spacing[:3] == (2.0, 2.0, 3.0)
+    
+    def test_dataset_that_fits_is_read_once(self, v73_mat_file, tmp_path, monkeypatch):
+        """A dataset within the memory budget is read in one call, not once per spectral point."""
+        h5py = pytest.importorskip("h5py")
+        mat_file, data = v73_mat_file
+        reads = []
+        read_direct = h5py.Dataset.read_direct
+        
+        def counting_read_direct(self, *args, **kwargs):
+            reads.append(self.name)
+            return read_direct(self, *args, **kwargs)
+        
+        monkeypatch.setattr(h5py.Dataset, 'read_direct', counting_read_direct)
+        convert_spectral_mat_to_nifti(mat_file, str(tmp_path / 'nifti'), png=False)
+        assert reads.count('/data') == 1
+    
+    def test_ranges_follow_chunks_within_budget(self, v73_mat_file):
+        h5py = pytest.importorskip("h5py")
+        mat_file, data = v73_mat_file
+        volume_bytes = data[..., 0].nbytes
+        with h5py.File(mat_file, 'r') as f:
+            dataset = f['data']
+            # Room for 9 points (hyperslab plus split copy): cut back to two 4-point chunks
+            assert _hdf5_spectral_ranges(dataset, 2 * 9 * volume_bytes) == [(0, 8), (8, 11)]
+            assert _hdf5_spectral_ranges(dataset, 10 ** 12) == [(0, 11)]
+            # Less than one chunk fits: single points
+            assert _hdf5_spectral_ranges(dataset, 2 * volume_bytes)[:2] == [(0, 1), (1, 2)]
+            groups = list(_read_hdf5_spectral_groups(dataset, 2 * 9 * volume_bytes))
+        np.testing.assert_array_equal(np.concatenate([volumes for _, volumes in groups]),
+                                      np.moveaxis(data, -1, 0))
+        assert [start for start, _ in groups] == [0, 8]
+
 if __name__ == '__main__':
     pytest.main([__file__])
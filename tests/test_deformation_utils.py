@@ -0,0 +1,62 @@
+import importlib.util
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+from torch._dynamo.exc import BackendCompilerFailed
+
+# Add src directory to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import deformation_utils
+
+
+class TestCompiledWarpFallback:
+
+    @pytest.fixture
+    def nifti_dir(self, tmp_path):
+        for n in range(5):
+            nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)),
+                     str(tmp_path / f"spectral_point_{n:03d}.nii.gz"))
+        return str(tmp_path)
+
+    @pytest.fixture
+    def fake_cuda(self, monkeypatch):
+        """Pretend a GPU is present and record the warp function of each batch instead of running it."""
+        calls = []
+        monkeypatch.setattr(deformation_utils.torch.cuda, 'is_available', lambda: True)
+        return calls
+
+    def _run(self, nifti_dir, tmp_path, monkeypatch, calls, compiled_error):
+        def fake_deform_batch(nifti_files, *args, warp_fn):
+            calls.append(warp_fn is deformation_utils._warp_elastic)
+            if warp_fn is not deformation_utils._warp_elastic:
+                raise compiled_error
+
+        monkeypatch.setattr(deformation_utils, '_deform_batch', fake_deform_batch)
+        deformation_utils.apply_nonlinear_deformation_to_nifti_files(nifti_dir, str(tmp_path / 'out'),
+                                                                     batch_size=2)
+
+    def test_compile_failure_falls_back_to_eager(self, nifti_dir, tmp_path, monkeypatch, fake_cuda):
+        if importlib.util.find_spec("triton") is None:
+            pytest.skip("Triton is not installed, so the warp is never compiled")
+        error = BackendCompilerFailed(lambda *args: None, RuntimeError("triton failed"), None)
+        self._run(nifti_dir, tmp_path, monkeypatch, fake_cuda, error)
+        # The first batch is retried eagerly and later batches stay eager
+        assert fake_cuda == [False, True, True, True]
+
+    def test_runtime_error_propagates(self, nifti_dir, tmp_path, monkeypatch, fake_cuda):
+        if importlib.util.find_spec("triton") is None:
+            pytest.skip("Triton is not installed, so the warp is never compiled")
+        with pytest.raises(RuntimeError, match="out of memory"):
+            self._run(nifti_dir, tmp_path, monkeypatch, fake_cuda, RuntimeError("CUDA out of memory"))
+        assert fake_cuda == [False]
+
+    def test_without_triton_runs_eager(self, nifti_dir, tmp_path, monkeypatch, fake_cuda):
+        find_spec = importlib.util.find_spec
+        monkeypatch.setattr(importlib.util, 'find_spec',
+                            lambda name, *args: None if name == "triton" else find_spec(name, *args))
+        self._run(nifti_dir, tmp_path, monkeypatch, fake_cuda, AssertionError("compiled warp used"))
+        assert fake_cuda == [True, True, True]
@@ -0,0 +1,184 @@
+import collections
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import nibabel as nib
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+# Add src directory to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import nifti_registration_pipeline as pipeline
+
+
+def _write_volumes(directory, count, shape=(6, 5, 4), seed=0):
+    """Write count random float32 spectral_point_NNN.nii.gz volumes and return their paths."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for n in range(count):
+        path = os.path.join(str(directory), f"spectral_point_{n:03d}.nii.gz")
+        sitk.WriteImage(sitk.GetImageFromArray(rng.random(shape, dtype=np.float32)), path)
+        paths.append(path)
+    return paths
+
+
+class TestPrefetchMovingImages:
+
+    def test_reader_error_is_raised_after_earlier_images(self, tmp_path, monkeypatch):
+        """A non-RuntimeError in the reader thread reaches the consumer once earlier images are yielded."""
+        paths = _write_volumes(tmp_path, 3)
+        read_image = sitk.ReadImage
+
+        def failing_read(path, *args):
+            if path == paths[1]:
+                raise MemoryError("reader died")
+            return read_image(path, *args)
+
+        monkeypatch.setattr(pipeline.sitk, 'ReadImage', failing_read)
+        yielded = []
+        with pytest.raises(MemoryError):
+            for i, args, moving_image in pipeline._prefetch_moving_images(
+                    (i, (path,)) for i, path in enumerate(paths)):
+                yielded.append(i)
+        assert yielded == [0]
+
+    def test_sequential_registration_surfaces_reader_error(self, tmp_path, monkeypatch):
+        """register_nifti_directory with one worker must not end quietly with files unrecorded."""
+        input_dir = tmp_path / 'input'
+        input_dir.mkdir()
+        paths = _write_volumes(input_dir, 3)
+        read_image = sitk.ReadImage
+
+        def failing_read(path, *args):
+            if path == paths[2]:
+                raise MemoryError("reader died")
+            return read_image(path, *args)
+
+        registered = []
+        monkeypatch.setattr(pipeline.sitk, 'ReadImage', failing_read)
+        monkeypatch.setattr(pipeline, 'register_single_nifti_file',
+                            lambda args, moving_image=None, fixed_image=None: registered.append(args[0]) or {
+                                'input_file': args[0], 'output_file': args[0], 'success': True,
+                                'message': "registered"})
+        with pytest.raises(MemoryError):
+            pipeline.register_nifti_directory(str(input_dir), paths[0], str(tmp_path / 'output'),
+                                              num_processes=1)
+        assert registered == paths[:2]
+
+
+class TestWorkerGpuPinning:
+
+    def test_each_worker_thread_keeps_one_gpu_and_stream(self, tmp_path, monkeypatch):
+        """Threads take GPUs in turn once; every file a thread registers runs on that GPU and stream."""
+        input_dir = tmp_path / 'input'
+        input_dir.mkdir()
+        paths = _write_volumes(input_dir, 12)
+        created_streams = []
+        seen = []
+
+        class FakeStream:
+            def __init__(self, device):
+                self.device = device
+                created_streams.append(self)
+
+        @contextlib.contextmanager
+        def fake_device(gpu_id):
+            yield
+
+        @contextlib.contextmanager
+        def fake_stream(stream):
+            yield
+
+        def fake_register(args, moving_image=None, fixed_image=None):
+            seen.append((threading.get_ident(), pipeline._thread_device.gpu_id, pipeline._thread_device.stream))
+            time.sleep(0.01)
+            return {'input_file': args[0], 'output_file': args[0], 'success': True, 'message': "registered"}
+
+        monkeypatch.setattr(pipeline.torch.cuda, 'device_count', lambda: 2)
+        monkeypatch.setattr(pipeline.torch.cuda, 'Stream', FakeStream)
+        monkeypatch.setattr(pipeline.torch.cuda, 'device', fake_device)
+        monkeypatch.setattr(pipeline.torch.cuda, 'stream', fake_stream)
+        monkeypatch.setattr(pipeline, 'register_single_nifti_file', fake_register)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = pipeline.register_nifti_directory(str(input_dir), paths[0], str(tmp_path / 'output'),
+                                                        num_processes=4)
+
+        assert results['successful'] == len(paths)
+        per_thread = collections.defaultdict(set)
+        for thread_id, gpu_id, stream in seen:
+            per_thread[thread_id].add((gpu_id, stream))
+        assert all(len(pairs) == 1 for pairs in per_thread.values())
+        # One stream per worker thread, GPUs handed out in turn
+        assert len(created_streams) == len(per_thread) <= 4
+        assert sorted(stream.device for stream in created_streams) == sorted(
+            n % 2 for n in range(len(created_streams)))
+
+
+class TestAverageTemplate:
+
+    @pytest.fixture
+    def mixed_inputs(self, tmp_path):
+        """Uncompressed, compressed and mismatched volumes, in Fortran order as NIfTI stores them."""
+        rng = np.random.default_rng(1)
+        shape = (9, 7, 11)
+        volumes = [rng.random(shape, dtype=np.float32) * 100 for _ in range(7)]
+        paths = []
+        for n, data in enumerate(volumes):
+            extension = '.nii' if n % 2 == 0 else '.nii.gz'
+            path = str(tmp_path / f"spectral_point_{n:03d}{extension}")
+            nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+            paths.append(path)
+        mismatched = str(tmp_path / "spectral_point_007.nii")
+        nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)), mismatched)
+        paths.insert(3, mismatched)
+        return paths, np.mean(np.stack(volumes).astype(np.float64), axis=0)
+
+    def _average(self, paths, output_path, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert pipeline.generate_average_template(paths, output_path, **kwargs)
+        return np.asarray(nib.load(output_path).dataobj)
+
+    def test_streaming_matches_stacked(self, mixed_inputs, tmp_path, monkeypatch):
+        """The memmap path (forced with a zero budget) averages like the in-memory stack."""
+        paths, expected = mixed_inputs
+        # Small tiles so each volume is summed in several slabs across threads
+        monkeypatch.setattr(pipeline, 'TILE_BYTES', 9 * 7 * 4 * 3)
+        stacked = self._average(paths, str(tmp_path / 'stacked.nii'), max_workers=3)
+        streamed = self._average(paths, str(tmp_path / 'streamed.nii'), max_workers=3, group_size=3,
+                                 stack_budget_bytes=0)
+        np.testing.assert_allclose(stacked, expected, rtol=1e-5)
+        np.testing.assert_allclose(streamed, stacked, rtol=1e-5)
+
+    def test_stacked_skips_mismatched_volumes_in_place(self, tmp_path):
+        """A skipped volume is compacted out of the stack without copying the whole stack."""
+        shape = (48, 40, 32)
+        rng = np.random.default_rng(2)
+        volumes = [rng.random(shape, dtype=np.float32) for _ in range(8)]
+        paths = []
+        for n, data in enumerate(volumes):
+            path = str(tmp_path / f"spectral_point_{n:03d}.nii")
+            nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+            paths.append(path)
+        mismatched = str(tmp_path / "spectral_point_008.nii")
+        nib.save(nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)), mismatched)
+        paths.insert(0, mismatched)
+
+        stack_bytes = len(paths) * volumes[0].nbytes
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                volume_sum, valid_count = pipeline._sum_stacked(paths, shape, max_workers=2)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert valid_count == len(volumes)
+        np.testing.assert_allclose(volume_sum, np.sum(volumes, axis=0), rtol=1e-5)
+        # The stack, the sum and a few volumes being read; a second stack would double it
+        assert peak < 1.5 * stack_bytes
@@ -0,0 +1,111 @@
+import contextlib
+import io
+import os
+import sys
+import threading
+
+import nibabel as nib
+import numpy as np
+import torch
+
+# Add src directory to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from _seeding import SeededDropout, call_generator, seeded_build, use_seeded_dropout
+from aligner import Aligner
+
+
+def _build_linear():
+    return torch.nn.Linear(8, 8)
+
+
+class TestSeededBuild:
+
+    def test_weights_do_not_depend_on_global_draws(self):
+        """Draws from the global generator before a build do not change its weights."""
+        first = seeded_build(_build_linear)
+        torch.rand(1000)
+        second = seeded_build(_build_linear)
+        assert torch.equal(first.weight, second.weight)
+
+    def test_global_generator_state_is_restored(self):
+        torch.manual_seed(0)
+        expected = torch.rand(5)
+        torch.manual_seed(0)
+        seeded_build(_build_linear)
+        assert torch.equal(torch.rand(5), expected)
+
+    def test_concurrent_builds_match(self):
+        """Threads building while another trains with seeded dropout get the same weights."""
+        reference = seeded_build(_build_linear).weight
+        weights = []
+        stop = threading.Event()
+
+        def draw():
+            dropout = SeededDropout(0.2, call_generator("cpu"))
+            while not stop.is_set():
+                dropout(torch.ones(100))
+
+        drawer = threading.Thread(target=draw)
+        drawer.start()
+        try:
+            builders = [threading.Thread(target=lambda: weights.append(seeded_build(_build_linear).weight))
+                        for _ in range(4)]
+            for builder in builders:
+                builder.start()
+            for builder in builders:
+                builder.join()
+        finally:
+            stop.set()
+            drawer.join()
+        assert all(torch.equal(weight, reference) for weight in weights)
+
+
+class TestSeededDropout:
+
+    def test_masks_follow_the_generator(self):
+        x = torch.ones(1000)
+        first = SeededDropout(0.2, call_generator("cpu"))(x)
+        torch.rand(100)
+        second = SeededDropout(0.2, call_generator("cpu"))(x)
+        assert torch.equal(first, second)
+        # Kept values are rescaled by 1 / (1 - p) as in torch.nn.Dropout
+        assert set(first.unique().tolist()) <= {0.0, 1.25}
+
+    def test_eval_is_identity(self):
+        dropout = SeededDropout(0.2, call_generator("cpu")).eval()
+        x = torch.rand(10)
+        assert dropout(x) is x
+
+    def test_replaces_nested_dropout(self):
+        model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Sequential(torch.nn.Dropout(0.3)))
+        use_seeded_dropout(model, call_generator("cpu"))
+        assert isinstance(model[1][0], SeededDropout)
+        assert model[1][0].p == 0.3
+
+
+class TestConcurrentAffine:
+
+    def test_threads_match_sequential_run(self, tmp_path):
+        """Affine registrations on concurrent threads give the same result as one run alone."""
+        rng = np.random.default_rng(0)
+        for name in ('fixed', 'moving'):
+            nib.save(nib.Nifti1Image(rng.random((20, 18, 16)).astype(np.float32), np.eye(4)),
+                     str(tmp_path / f'{name}.nii.gz'))
+
+        def run(tag):
+            output = str(tmp_path / f'affine_{tag}.nii.gz')
+            Aligner().affine_reg(str(tmp_path / 'fixed.nii.gz'), str(tmp_path / 'moving.nii.gz'), output,
+                                 None, nn_input_size=16, max_epochs=10, device="cpu")
+            return np.asarray(nib.load(output).dataobj)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = run('sequential')
+            threads = [threading.Thread(target=run, args=(n,)) for n in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for n in range(3):
+            np.testing.assert_array_equal(np.asarray(nib.load(str(tmp_path / f'affine_{n}.nii.gz')).dataobj),
+                                          expected)
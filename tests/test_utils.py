@@ -0,0 +1,100 @@
+import os
+import sys
+
+import numpy as np
+import scipy.io as sio
+
+# Add src directory to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils import HDF5_SIGNATURE, find_spectral_point_files, interpolate_zeros, is_hdf5_mat
+from spectral_mat_to_nifti import _select_mat_variables
+from spectral_nifti_to_mat import MAT_CLASS_DTYPES
+
+
+class TestFindSpectralPointFiles:
+
+    def test_orders_by_spectral_index(self, tmp_path):
+        """spectral_point_2 must come before spectral_point_10 without zero padding."""
+        for name in ['spectral_point_10.nii.gz', 'spectral_point_2.nii.gz', 'spectral_point_1.nii.gz']:
+            (tmp_path / name).touch()
+        files = find_spectral_point_files(str(tmp_path))
+        assert [os.path.basename(f) for f in files] == [
+            'spectral_point_1.nii.gz', 'spectral_point_2.nii.gz', 'spectral_point_10.nii.gz']
+
+    def test_matches_suffixed_names_only(self, tmp_path):
+        """Suffixed outputs match; other files and other extensions are ignored."""
+        for name in ['spectral_point_001.reg.nii.gz', 'spectral_point_000_deformed.nii.gz',
+                     'spectral_point_002.png', 'template.nii.gz', 'spectral_metadata.txt']:
+            (tmp_path / name).touch()
+        files = find_spectral_point_files(str(tmp_path))
+        assert [os.path.basename(f) for f in files] == [
+            'spectral_point_000_deformed.nii.gz', 'spectral_point_001.reg.nii.gz']
+
+
+class TestIsHdf5Mat:
+
+    def test_signature_at_offset_0(self, tmp_path):
+        mat_file = tmp_path / 'plain.mat'
+        mat_file.write_bytes(HDF5_SIGNATURE + b'\0' * 64)
+        assert is_hdf5_mat(str(mat_file))
+
+    def test_signature_after_matlab_user_block(self, tmp_path):
+        """MATLAB v7.3 files put a 512-byte text header before the HDF5 superblock."""
+        mat_file = tmp_path / 'v73.mat'
+        mat_file.write_bytes(b'MATLAB 7.3 MAT-file'.ljust(512, b' ') + HDF5_SIGNATURE + b'\0' * 64)
+        assert is_hdf5_mat(str(mat_file))
+
+    def test_v5_mat_is_not_hdf5(self, tmp_path):
+        mat_file = tmp_path / 'v5.mat'
+        sio.savemat(str(mat_file), {'data': np.zeros((2, 2, 2, 2))})
+        assert not is_hdf5_mat(str(mat_file))
+
+    def test_short_file_is_not_hdf5(self, tmp_path):
+        mat_file = tmp_path / 'short.mat'
+        mat_file.write_bytes(b'\x89HDF')
+        assert not is_hdf5_mat(str(mat_file))
+
+
+class TestSelectMatVariables:
+
+    def test_prefers_data_and_keeps_resolution(self, tmp_path):
+        mat_file = tmp_path / 'in.mat'
+        sio.savemat(str(mat_file), {'extra': np.zeros((50, 50)), 'data': np.zeros((2, 3, 4, 5)),
+                                    'resolution': np.array([2.0, 2.0, 3.0])})
+        assert _select_mat_variables(str(mat_file)) == ['data', 'resolution']
+
+    def test_falls_back_to_largest_variable(self, tmp_path):
+        mat_file = tmp_path / 'in.mat'
+        sio.savemat(str(mat_file), {'small': np.zeros((2, 2)), 'spectra': np.zeros((2, 3, 4, 5))})
+        assert _select_mat_variables(str(mat_file)) == ['spectra']
+
+
+class TestMatClassDtypes:
+
+    def test_whosmat_class_maps_to_loadmat_dtype(self, tmp_path):
+        """The dtype probed from the variable header matches what loadmat returns."""
+        mat_file = tmp_path / 'in.mat'
+        dtypes = [np.float64, np.float32, np.int8, np.uint8, np.int16, np.uint16,
+                  np.int32, np.uint32, np.int64, np.uint64]
+        sio.savemat(str(mat_file), {f'v{i}': np.ones((2, 3), dtype=dtype) for i, dtype in enumerate(dtypes)})
+        loaded = sio.loadmat(str(mat_file))
+        for name, _, mat_class in sio.whosmat(str(mat_file)):
+            assert MAT_CLASS_DTYPES[mat_class] == loaded[name].dtype
+
+
+class TestInterpolateZeros:
+
+    def test_fills_zeros_inside_mask_from_nearest_voxel(self):
+        image = np.array([[[1.0, 0.0, 0.0, 4.0]]])
+        mask = np.array([[[1, 1, 1, 0]]])
+        result = interpolate_zeros(image, mask)
+        # The voxel at index 2 is nearer to 4.0, but that voxel is outside the mask
+        np.testing.assert_array_equal(result, [[[1.0, 1.0, 1.0, 4.0]]])
+
+    def test_leaves_zeros_outside_mask(self):
+        image = np.array([[[0.0, 2.0, 0.0]]])
+        mask = np.array([[[0, 1, 1]]])
+        result = interpolate_zeros(image, mask)
+        np.testing.assert_array_equal(result, [[[0.0, 2.0, 2.0]]])
+        assert result is not image